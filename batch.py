@@ -0,0 +1,213 @@
+import argparse
+import glob
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from PIL import Image
+
+from core import (
+    BACKENDS, DEFAULT_LINES, DEFAULT_CACHE_DIR, DEFAULT_CACHE_SIZE, EXPORT_FORMATS, MODEL_TILE_SIZES, TILE_ATTEMPTS,
+    UPLOAD_FORMATS, RetryPolicy, TileGrid, UpscaleCache, UpscaleRun, create_session, detect_grid_lines, grid_lines
+)
+from strips import save_tiles_streamed
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+# Download session shared by every file a worker process handles, set up by init_worker
+session = None
+
+
+def parse_lines(value):
+    lines = sorted(float(v) for v in value.split(",") if v.strip())
+    if any(not 0 < line < 1 for line in lines):
+        raise argparse.ArgumentTypeError("line positions must be fractions between 0 and 1")
+    return lines
+
+
+def parse_grid(value):
+    try:
+        rows, cols = (int(v) for v in value.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError("grid must look like ROWSxCOLS, e.g. 4x4")
+    if rows < 1 or cols < 1:
+        raise argparse.ArgumentTypeError("grid must have at least one row and one column")
+    return rows, cols
+
+
+def expand_inputs(patterns):
+    paths = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) or ([pattern] if os.path.isfile(pattern) else [])
+        if not matches:
+            logging.warning(f"No files match {pattern}")
+        paths.extend(match for match in matches if os.path.isfile(match) and match not in paths)
+    return paths
+
+
+def output_names(paths):
+    # Subdirectory of the output for each input: its file name without the extension, unless other
+    # inputs share that name. Those keep their folders below the one they have in common, and the
+    # extension too when they are in the same folder, so no two images write into one directory.
+    groups = {}
+    for path in paths:
+        groups.setdefault(os.path.splitext(os.path.basename(path))[0], []).append(path)
+    names = {}
+    for stem, group in groups.items():
+        if len(group) == 1:
+            names[group[0]] = stem
+            continue
+        root = os.path.commonpath([os.path.dirname(os.path.abspath(path)) for path in group])
+        relative = {path: os.path.splitext(os.path.relpath(os.path.abspath(path), root))[0] for path in group}
+        for path in group:
+            name = relative[path]
+            if list(relative.values()).count(name) > 1:
+                name += "_" + os.path.splitext(path)[1].lstrip(".").lower()
+            names[path] = name
+    return names
+
+
+def init_worker(concurrency):
+    global session
+    session = create_session(concurrency)
+
+
+def process_file(path, save_path, h_lines, v_lines, model, concurrency, cache_dir=None, cache_size=DEFAULT_CACHE_SIZE,
+                 upload_format="PNG", export_format="JPEG", quality=100, seamless=False, attempts=TILE_ATTEMPTS,
+                 auto_grid=False, pack=False):
+    # Runs in a worker process: cut one image and either save the tiles or upscale them into save_path
+    os.makedirs(save_path, exist_ok=True)
+    stats = {"tiles": 0, "bytes_read": os.path.getsize(path), "bytes_written": 0}
+
+    with Image.open(path) as image:
+        if seamless:
+            grid = TileGrid.for_tile_size(image, MODEL_TILE_SIZES[model])
+        else:
+            if auto_grid:
+                detected = detect_grid_lines(image)
+                if detected[0] or detected[1]:
+                    h_lines, v_lines = detected
+                    logging.info(f"{path}: auto grid found {len(h_lines) + 1} rows x {len(v_lines) + 1} columns")
+                else:
+                    logging.info(f"{path}: auto grid found no gutters or seams, using the given lines")
+            grid = TileGrid.from_lines(image, h_lines, v_lines)
+        stats["tiles"] = len(grid)
+
+        if not model:
+            # Files are already spread across processes, so each one saves its tiles on a single thread.
+            # The source is read in bands where its format allows, so huge scans aren't decoded whole.
+            paths = save_tiles_streamed(grid, path, save_path, export_format, quality)
+            stats["bytes_written"] = sum(os.path.getsize(p) for p in paths)
+            return stats
+
+        cache = UpscaleCache(cache_dir, cache_size) if cache_dir and BACKENDS[model].remote else None
+        # Files are already spread across processes, so each one prepares its tiles on a single thread
+        upscale = UpscaleRun(grid, save_path, model, concurrency, cache, upload_format, seamless, pack,
+                             retry=RetryPolicy(attempts), session=session, prefetch_workers=1,
+                             log=lambda message: logging.info(f"{path}: {message}"))
+        stats["requests"] = len(upscale.jobs)
+        output_path = upscale.run()
+        stats["bytes_written"] = sum(upscale.written)
+        stats["bytes_uploaded"] = sum(upscale.uploaded)
+        stats["skipped"] = sum(tile.source == "skipped" for tile in upscale.report.tiles)
+        if output_path:
+            stats["bytes_written"] += os.path.getsize(output_path)
+        if cache is not None:
+            stats["cache_hits"], stats["cache_misses"] = cache.hits, cache.misses
+
+    return stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cut and upscale images without the GUI.")
+    parser.add_argument("inputs", nargs="+", help="image files or glob patterns (quote them to use ** recursion)")
+    parser.add_argument("-o", "--output", required=True, help="directory for the results, one subdirectory per image")
+    parser.add_argument("--grid", type=parse_grid, help="cut into an even ROWSxCOLS grid")
+    parser.add_argument("--h-lines", type=parse_lines, help="horizontal cut positions as fractions, e.g. 0.3,0.6")
+    parser.add_argument("--v-lines", type=parse_lines, help="vertical cut positions as fractions, e.g. 0.5")
+    parser.add_argument("--auto-grid", action="store_true",
+                        help="cut along the gutters or seams found in each image; images without any use the lines above")
+    parser.add_argument("--model", choices=list(BACKENDS),
+                        help="upscale the tiles with this model instead of saving them (local/lanczos runs offline)")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="JPEG", help="format of the saved tiles")
+    parser.add_argument("--quality", type=int, default=100, help="JPEG/WebP quality of the saved tiles (WebP 100 is lossless)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="number of images processed in parallel")
+    parser.add_argument("--concurrency", type=int, default=4, help="tiles in flight per image while upscaling")
+    parser.add_argument("--seamless", action="store_true",
+                        help="upscale the whole image as overlapping model-sized tiles and stitch them into one PNG")
+    parser.add_argument("--pack", action="store_true",
+                        help="upscale small tiles several at a time, packed into model-sized atlases")
+    parser.add_argument("--attempts", type=int, default=TILE_ATTEMPTS,
+                        help="attempts per tile before it is left for the next run over the same output directory")
+    parser.add_argument("--upload-format", choices=list(UPLOAD_FORMATS), default="PNG", help="encoding used to upload tiles")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="directory of the upscaled tile cache")
+    parser.add_argument("--cache-size", type=float, default=DEFAULT_CACHE_SIZE / 1024 ** 3, help="cache size cap in GB")
+    parser.add_argument("--no-cache", action="store_true", help="always upscale, ignoring cached results")
+    args = parser.parse_args(argv)
+
+    if args.seamless and not args.model:
+        parser.error("--seamless requires --model")
+    if args.pack and not args.model:
+        parser.error("--pack requires --model")
+    if args.seamless and (args.auto_grid or args.pack):
+        parser.error("--auto-grid and --pack cannot be combined with --seamless")
+    if args.grid and (args.h_lines or args.v_lines):
+        parser.error("--grid cannot be combined with --h-lines/--v-lines")
+    if args.grid:
+        h_lines, v_lines = grid_lines(args.grid[0]), grid_lines(args.grid[1])
+    else:
+        h_lines = args.h_lines if args.h_lines is not None else list(DEFAULT_LINES)
+        v_lines = args.v_lines if args.v_lines is not None else list(DEFAULT_LINES)
+
+    paths = expand_inputs(args.inputs)
+    if not paths:
+        parser.error("no input images found")
+    os.makedirs(args.output, exist_ok=True)
+    names = output_names(paths)
+
+    cache_dir = None if args.no_cache else args.cache_dir
+    cache_size = int(args.cache_size * 1024 ** 3)
+
+    totals = {"images": 0, "failed": 0, "tiles": 0, "requests": 0, "skipped": 0, "bytes": 0, "cache_hits": 0, "cache_misses": 0}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=max(1, args.workers), initializer=init_worker,
+                             initargs=(max(1, args.concurrency),)) as executor:
+        futures = {
+            executor.submit(process_file, path, os.path.join(args.output, names[path]), h_lines, v_lines, args.model, max(1, args.concurrency),
+                            cache_dir, cache_size, args.upload_format, args.format, args.quality, args.seamless,
+                            max(1, args.attempts), args.auto_grid, args.pack): path
+            for path in paths
+        }
+        for future in as_completed(futures):
+            path = futures[future]
+            try:
+                stats = future.result()
+            except Exception as e:
+                totals["failed"] += 1
+                logging.error(f"{path}: {e}")
+                continue
+            totals["images"] += 1
+            totals["tiles"] += stats["tiles"]
+            totals["skipped"] += stats.get("skipped", 0)
+            totals["requests"] += stats.get("requests", 0)
+            totals["bytes"] += stats["bytes_read"] + stats["bytes_written"] + stats.get("bytes_uploaded", 0)
+            totals["cache_hits"] += stats.get("cache_hits", 0)
+            totals["cache_misses"] += stats.get("cache_misses", 0)
+    elapsed = time.perf_counter() - start
+
+    print(f"Processed {totals['images']} images ({totals['failed']} failed), {totals['tiles']} tiles in {elapsed:.2f} s")
+    print(f"  {totals['images'] / elapsed:.2f} images/sec, {totals['tiles'] / elapsed:.2f} tiles/sec, "
+          f"{totals['bytes'] / 1e6:.1f} MB moved ({totals['bytes'] / 1e6 / elapsed:.1f} MB/s)")
+    if args.model:
+        print(f"  {totals['requests']} upscale requests for {totals['tiles']} tiles")
+    if totals["skipped"]:
+        print(f"  Skipped {totals['skipped']} requests finished by an earlier run")
+    if args.model and cache_dir and BACKENDS[args.model].remote:
+        print(f"  Cache: {totals['cache_hits']} hits, {totals['cache_misses']} misses")
+    return 1 if totals["failed"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,531 @@
+"""Benchmarks for the CutAndScale pipeline.
+
+Usage:
+    python bench.py [benchmark ...] [options]
+
+Runs every benchmark when no names are given, over synthetic images of each
+--sizes megapixel count and each --grids grid. Every case runs in a fresh
+process and reports the process peak and the memory the stage itself added.
+The fal queue and the result downloads are replaced by a local fake with
+--latency and --bandwidth, so upscale runs are reproducible and cost nothing.
+Qt runs on its offscreen platform unless QT_QPA_PLATFORM says otherwise, so
+no display is needed.
+
+The startup benchmark imports each entry point in a fresh interpreter with
+-X importtime instead, and fails the run when one goes over its budget in
+STARTUP_BUDGETS_MS or imports a module that should only load on first use.
+
+Results are saved to bench_results/<commit>.json; pass --compare with an
+earlier file to print the change against it.
+"""
+import argparse
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+# Set before anything imports Qt; the spawned case processes inherit it
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+MEGAPIXELS = (1, 12, 50, 200)
+DEFAULT_MEGAPIXELS = (1, 12, 50)  # 200 MP needs a few GB of memory and minutes per case
+DEFAULT_GRIDS = (2, 4, 8)
+DEFAULT_LATENCY = 0.5  # Seconds each fake request spends in the queue and in inference
+DEFAULT_BANDWIDTH = 50.0  # MB/s for fake uploads and downloads
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_results")
+# Cold import time of each entry point. core is what scripted cuts pay; the budgets leave room
+# for slower machines while still catching an eager import of numpy or the networking stack.
+STARTUP_BUDGETS_MS = {"core": 150, "batch": 250, "splitter": 600}
+LAZY_MODULES = ("numpy", "requests", "httpx", "fal_client")  # Imported by core on first use
+
+
+def synthetic_image(width, height, mode="RGB"):
+    # Noise-free gradient: cheap to build, but not trivially compressible like a flat color
+    gradient = Image.linear_gradient("L").resize((width, height))
+    return Image.merge("RGB", (gradient, gradient.transpose(Image.FLIP_LEFT_RIGHT), gradient.rotate(90))).convert(mode)
+
+
+def megapixel_size(megapixels):
+    # 3:2, the usual camera aspect ratio
+    width = round((megapixels * 1e6 * 3 / 2) ** 0.5)
+    return width, round(megapixels * 1e6 / width)
+
+
+def measure(func, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+def rss_mb():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 ** 2
+
+
+class MemorySampler:
+    # Samples the resident set while a stage runs, so a stage's peak is measured above the memory
+    # in use when it started rather than above the setup's peak. Needs /proc; elsewhere it falls
+    # back to the growth of the process peak, which hides stages that stay under the setup's.
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.sampling = os.path.exists("/proc/self/statm")
+        self.stop = threading.Event()
+
+    def __enter__(self):
+        self.start_mb = rss_mb() if self.sampling else peak_rss_mb()
+        self.peak_mb = self.start_mb
+        if self.sampling:
+            self.thread = threading.Thread(target=self.sample, daemon=True)
+            self.thread.start()
+        return self
+
+    def sample(self):
+        while not self.stop.wait(self.interval):
+            self.peak_mb = max(self.peak_mb, rss_mb())
+
+    def __exit__(self, *exc):
+        if self.sampling:
+            self.stop.set()
+            self.thread.join()
+            self.peak_mb = max(self.peak_mb, rss_mb())
+        else:
+            self.peak_mb = peak_rss_mb()
+
+    @property
+    def growth_mb(self):
+        return self.peak_mb - self.start_mb
+
+
+class FakeFal:
+    # Stands in for fal_client and the result CDN: uploads and downloads take
+    # size / bandwidth, and each request is queued and then in inference for `latency`
+    # seconds. Results are served by a local HTTP server, so the real download path runs.
+    def __init__(self, latency=DEFAULT_LATENCY, bandwidth=DEFAULT_BANDWIDTH, scale=4):
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        self.latency = latency
+        self.bytes_per_second = bandwidth * 1e6
+        self.scale = scale
+        self.uploads = {}
+        self.requests = {}
+        self.counter = itertools.count()
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                body = fake.result_body(self.path.rsplit("/", 1)[-1])
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                chunk_size = 256 * 1024
+                for start in range(0, len(body), chunk_size):
+                    part = body[start:start + chunk_size]
+                    self.wfile.write(part)
+                    time.sleep(len(part) / fake.bytes_per_second)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @property
+    def submitted(self):
+        return len(self.requests)
+
+    def result_body(self, request_id):
+        # A flat PNG of the upscaled size, so results can be decoded and sliced, padded past its
+        # end to roughly scale² times the uploaded bytes; PNG readers stop at the IEND chunk.
+        # Keeps the fake cheap on the CPU the benchmark is measuring.
+        (width, height), uploaded = self.requests[request_id][1:]
+        buffer = io.BytesIO()
+        Image.new("RGB", (width * self.scale, height * self.scale), "gray").save(buffer, "PNG", compress_level=1)
+        return buffer.getvalue().ljust(uploaded * self.scale ** 2, b"\0")
+
+    def install(self):
+        import core
+        import fal_client
+        from fal_client import Completed, InProgress, Queued
+
+        class Handle:
+            def __init__(self, request_id):
+                self.request_id = request_id
+
+        def upload(data, content_type):
+            time.sleep(len(data) / self.bytes_per_second)
+            url = f"fake://upload-{next(self.counter)}"
+            self.uploads[url] = bytes(data)
+            return url
+
+        def submit(model, arguments):
+            request_id = f"fake-{next(self.counter)}"
+            data = self.uploads.pop(arguments["image_url"])
+            with Image.open(io.BytesIO(data)) as uploaded:
+                self.requests[request_id] = (time.perf_counter(), uploaded.size, len(data))
+            return Handle(request_id)
+
+        def status(model, request_id, with_logs=False):
+            elapsed = time.perf_counter() - self.requests[request_id][0]
+            if elapsed < self.latency / 2:
+                return Queued(position=0)
+            if elapsed < self.latency:
+                return InProgress(logs=[])
+            return Completed(logs=[], metrics={"inference_time": self.latency / 2})
+
+        def result(model, request_id):
+            return {"image": {"url": f"http://127.0.0.1:{self.server.server_port}/{request_id}"}}
+
+        fal_client.upload = upload
+        fal_client.submit = submit
+        fal_client.status = status
+        fal_client.result = result
+        core.QUEUE_POLL_INTERVAL = max(0.01, min(core.QUEUE_POLL_INTERVAL, self.latency / 10))
+
+
+# Each benchmark takes (image, grid_size, options) and returns a list of (variant, func) to time.
+# Setup happens in the benchmark itself, so only func counts towards time and stage memory.
+
+def bench_cut(image, grid_size, options):
+    from core import TileGrid, grid_lines
+
+    def cut():
+        grid = TileGrid.from_lines(image, grid_lines(grid_size), grid_lines(grid_size))
+        for tile in grid.tiles():
+            tile.load()
+    return [("crop all tiles", cut)]
+
+
+def bench_preview(image, grid_size, options):
+    from core import PreviewPyramid
+    return [("build pyramid", lambda: PreviewPyramid(image))]
+
+
+def bench_auto_grid(image, grid_size, options):
+    from core import detect_grid_lines
+    return [("detect", lambda: detect_grid_lines(image))]
+
+
+def bench_pil_to_qimage(image, grid_size, options):
+    # The raw buffer conversion against the PNG round trip it replaced, for opaque and
+    # transparent images; --sizes 2.07,8.29,33.18 match the pixel counts of 1080p, 4K and 8K
+    from PyQt5.QtGui import QImage
+    from core import PreviewPyramid
+    from splitter import ImageSplitter
+
+    def png_round_trip(pil_image):
+        # The conversion pil_to_qimage used before it wrapped raw buffers
+        buffer = io.BytesIO()
+        pil_image.save(buffer, format='PNG')
+        q_image = QImage()
+        q_image.loadFromData(buffer.getvalue())
+        return q_image
+
+    fitted = PreviewPyramid(image).fitted((1000, 700))
+    images = {"RGB": image, "RGBA": image.convert("RGBA")}
+    return [("preview raw", lambda: ImageSplitter.pil_to_qimage(fitted))] + [
+        variant
+        for mode, converted in images.items()
+        for variant in (
+            (f"raw {mode}", lambda converted=converted: ImageSplitter.pil_to_qimage(converted)),
+            (f"png round trip {mode}", lambda converted=converted: png_round_trip(converted)),
+        )
+    ]
+
+
+def bench_mosaic(image, grid_size, options):
+    from core import PreviewPyramid, TileGrid, grid_lines
+    from splitter import ImageSplitter
+
+    grid = TileGrid.from_lines(image, grid_lines(grid_size), grid_lines(grid_size))
+    preview = PreviewPyramid(image)
+    return [("compose", lambda: ImageSplitter.build_mosaic(grid, preview, (1000, 700)))]
+
+
+def bench_export(image, grid_size, options):
+    from core import TileGrid, grid_lines, save_tiles
+
+    grid = TileGrid.from_lines(image, grid_lines(grid_size), grid_lines(grid_size))
+
+    def export(export_format, workers):
+        with tempfile.TemporaryDirectory() as save_path:
+            save_tiles(grid, save_path, export_format, workers=workers)
+    return [
+        (f"{export_format} {'sequential' if workers == 1 else 'parallel'}",
+         lambda export_format=export_format, workers=workers: export(export_format, workers))
+        for export_format in options.formats for workers in (1, None)
+    ]
+
+
+def bench_cut_file(image, grid_size, options):
+    # Cutting a file on disk: decoded whole against read in bands by strips.py
+    from core import TileGrid, grid_lines, save_tiles
+    from strips import save_tiles_streamed
+
+    source_dir = tempfile.TemporaryDirectory()
+    sources = {
+        "TIFF": ("source.tif", {}),
+        "TIFF LZW": ("source_lzw.tif", {"compression": "tiff_lzw"}),
+        "PNG": ("source.png", {"compress_level": 1}),
+    }
+    for filename, save_options in sources.values():
+        image.save(os.path.join(source_dir.name, filename), **save_options)
+
+    def cut(filename, streamed):
+        path = os.path.join(source_dir.name, filename)
+        with Image.open(path) as source, tempfile.TemporaryDirectory() as save_path:
+            grid = TileGrid.from_lines(source, grid_lines(grid_size), grid_lines(grid_size))
+            if streamed:
+                save_tiles_streamed(grid, path, save_path)
+            else:
+                save_tiles(grid, save_path, workers=1)
+    return [
+        (f"{source} {'streamed' if streamed else 'in memory'}",
+         lambda filename=filename, streamed=streamed: cut(filename, streamed))
+        for source, (filename, _) in sources.items() for streamed in (False, True)
+    ]
+
+
+def bench_upscale(image, grid_size, options):
+    # Tile per request against small tiles packed into atlases, and the local backend; see
+    # "requests" in the results
+    from core import TileGrid, grid_lines
+    from splitter import UpscaleWorker
+
+    grid = TileGrid.from_lines(image, grid_lines(grid_size), grid_lines(grid_size))
+    fake = FakeFal(options.latency, options.bandwidth)
+    fake.install()
+
+    def upscale(model, pack):
+        # run() on this thread: no event loop is needed when nothing is connected to the signals
+        with tempfile.TemporaryDirectory() as save_path:
+            worker = UpscaleWorker(grid, save_path, model, options.concurrency, pack=pack)
+            submitted = fake.submitted
+            worker.run()
+            variants[model, pack].stages = worker.report.stage_summary()
+            variants[model, pack].requests = fake.submitted - submitted
+
+    variants = {
+        (model, pack): lambda model=model, pack=pack: upscale(model, pack)
+        for model, pack in (("fal-ai/aura-sr", False), ("fal-ai/aura-sr", True), ("local/lanczos", False))
+    }
+    return [
+        (f"{'local' if model == 'local/lanczos' else 'packed' if pack else 'per tile'} x{options.concurrency}",
+         variants[model, pack])
+        for model, pack in variants
+    ]
+
+
+def import_profile(module):
+    # Imports module in a fresh interpreter; returns its cumulative import time in seconds, the
+    # process peak in MB and which of LAZY_MODULES it pulled in
+    code = "\n".join([
+        "import resource, sys",
+        f"import {module}" if module else "",
+        f"print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, *(m for m in {LAZY_MODULES!r} if m in sys.modules))",
+    ])
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", code], capture_output=True, text=True,
+                               check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+    peak, *loaded = completed.stdout.split()
+    peak_mb = int(peak) / 1024 ** 2 if sys.platform == "darwin" else int(peak) / 1024
+    # Lines look like "import time:       self [us] |  cumulative | name", nested names indented
+    cumulative = sum(int(line.split("|")[1]) for line in completed.stderr.splitlines()
+                     if line.startswith("import time:") and line.split("|")[2].strip() == module)
+    return cumulative / 1e6, peak_mb, loaded
+
+
+def run_startup(options):
+    _, bare_mb, _ = import_profile(None)
+    results = []
+    for module, budget_ms in STARTUP_BUDGETS_MS.items():
+        profiles = [import_profile(module) for _ in range(options.repeat)]
+        seconds = statistics.median(profile[0] for profile in profiles)
+        peak_mb = max(profile[1] for profile in profiles)
+        results.append({
+            "benchmark": "startup",
+            "variant": f"import {module}",
+            "megapixels": 0,
+            "grid": "-",
+            "seconds": round(seconds, 4),
+            "peak_mb": round(peak_mb, 1),
+            "stage_mb": round(peak_mb - bare_mb, 1),
+            "budget_ms": budget_ms,
+            "eager_imports": profiles[0][2],
+        })
+    return results
+
+
+BENCHMARKS = {
+    "cut": bench_cut,
+    "preview": bench_preview,
+    "auto_grid": bench_auto_grid,
+    "pil_to_qimage": bench_pil_to_qimage,
+    "mosaic": bench_mosaic,
+    "export": bench_export,
+    "cut_file": bench_cut_file,
+    "upscale": bench_upscale,
+}
+
+
+# Benchmarks that paint into QImages and need a QApplication
+QT_BENCHMARKS = ("pil_to_qimage", "mosaic")
+
+
+def run_case(name, megapixels, grid_size, options):
+    # Runs in a fresh process; returns one result per variant of the benchmark
+    if name in QT_BENCHMARKS:
+        from PyQt5.QtWidgets import QApplication
+        app = QApplication.instance() or QApplication(sys.argv[:1])  # noqa: F841 - QImage needs an application
+
+    image = synthetic_image(*megapixel_size(megapixels))
+    image.load()
+    results = []
+    for variant, func in BENCHMARKS[name](image, grid_size, options):
+        with MemorySampler() as memory:
+            seconds = measure(func, repeat=options.repeat)
+        result = {
+            "benchmark": name,
+            "variant": variant,
+            "megapixels": megapixels,
+            "grid": f"{grid_size}x{grid_size}",
+            "seconds": round(seconds, 4),
+            "peak_mb": round(peak_rss_mb(), 1),
+            "stage_mb": round(memory.growth_mb, 1),
+        }
+        if hasattr(func, "requests"):
+            result["requests"] = func.requests
+        if hasattr(func, "stages"):
+            result["stages"] = func.stages
+        results.append(result)
+    return results
+
+
+def case_key(result):
+    return result["benchmark"], result["variant"], result["megapixels"], result["grid"]
+
+
+def print_result(result, previous=None):
+    line = (f"{result['benchmark']:<14} {result['variant']:<20} {result['megapixels']:>4} MP {result['grid']:>6}"
+            f" {result['seconds'] * 1000:10.1f} ms {result['peak_mb']:8.0f} MB peak {result['stage_mb']:7.0f} MB stage")
+    if "requests" in result:
+        line += f" {result['requests']:5d} requests"
+    if "budget_ms" in result:
+        line += f"   budget {result['budget_ms']} ms"
+        if over_budget(result):
+            line += " EXCEEDED"
+        if result["eager_imports"]:
+            line += f", imports {', '.join(result['eager_imports'])} up front"
+    if previous and previous["seconds"]:
+        line += f"   {result['seconds'] / previous['seconds']:5.2f}x time vs baseline"
+    print(line, flush=True)
+
+
+def over_budget(result):
+    return result["seconds"] * 1000 > result["budget_ms"] or bool(result["eager_imports"])
+
+
+def current_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                check=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], capture_output=True,
+                               text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return commit + ("-dirty" if dirty else "")
+
+
+def parse_list(value, cast=int):
+    return [cast(v) for v in value.split(",") if v.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the cut/preview/export/upscale pipeline.")
+    parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run: {', '.join(BENCHMARKS)}, startup (default: all)")
+    parser.add_argument("--sizes", type=lambda v: parse_list(v, float), default=list(DEFAULT_MEGAPIXELS),
+                        help=f"image sizes in megapixels, e.g. {','.join(str(m) for m in MEGAPIXELS)}")
+    parser.add_argument("--grids", type=parse_list, default=list(DEFAULT_GRIDS), help="NxN grid sizes, e.g. 2,4,8")
+    parser.add_argument("--formats", type=lambda v: parse_list(v, str), default=["JPEG", "PNG"],
+                        help="export formats to benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per case; the median is reported")
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY, help="seconds of fake queue plus inference per tile")
+    parser.add_argument("--bandwidth", type=float, default=DEFAULT_BANDWIDTH, help="fake upload and download bandwidth in MB/s")
+    parser.add_argument("--concurrency", type=int, default=4, help="tiles in flight during the upscale benchmark")
+    parser.add_argument("--save", help="results file (default: bench_results/<commit>.json)")
+    parser.add_argument("--no-save", action="store_true", help="don't write a results file")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    options = parser.parse_args(argv)
+
+    for name in options.benchmarks:
+        if name not in BENCHMARKS and name != "startup":
+            parser.error(f"unknown benchmark: {name}. Available: {', '.join(BENCHMARKS)}, startup")
+    names = options.benchmarks or list(BENCHMARKS) + ["startup"]
+    options.sizes = [int(m) if m == int(m) else m for m in options.sizes]
+
+    baseline = {}
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = {case_key(result): result for result in json.load(f)["results"]}
+
+    # Grid size doesn't change what preview, auto_grid and pil_to_qimage do, so they run once per image size
+    cases = [
+        (name, megapixels, grid_size)
+        for name in names if name != "startup" for megapixels in options.sizes
+        for grid_size in (options.grids[:1] if name in ("preview", "auto_grid", "pil_to_qimage") else options.grids)
+    ]
+    results = []
+    if "startup" in names:
+        for result in run_startup(options):
+            print_result(result, baseline.get(case_key(result)))
+            results.append(result)
+    context = multiprocessing.get_context("spawn")
+    for name, megapixels, grid_size in cases:
+        with context.Pool(1) as pool:
+            for result in pool.apply(run_case, (name, megapixels, grid_size, options)):
+                print_result(result, baseline.get(case_key(result)))
+                results.append(result)
+
+    if not options.no_save:
+        save_path = options.save or os.path.join(RESULTS_DIR, f"{current_commit()}.json")
+        os.makedirs(os.path.dirname(os.path.abspath(save_path)), exist_ok=True)
+        with open(save_path, "w") as f:
+            json.dump({
+                "commit": current_commit(),
+                "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                "machine": {"platform": platform.platform(), "python": platform.python_version(),
+                            "cpus": os.cpu_count()},
+                "options": {key: value for key, value in vars(options).items()
+                            if key not in ("save", "no_save", "compare")},
+                "results": results,
+            }, f, indent=2)
+        print(f"Results saved to {save_path}")
+
+    exceeded = [result for result in results if "budget_ms" in result and over_budget(result)]
+    for result in exceeded:
+        print(f"Startup budget exceeded: {result['variant']}", file=sys.stderr)
+    return 1 if exceeded else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
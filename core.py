@@ -0,0 +1,1392 @@
+import csv
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed
+
+from PIL import Image
+
+# numpy, requests, httpx and fal_client are imported in the functions that use them: together they
+# take longer to import than the rest of the app, and cutting, exporting or opening the GUI needs none
+
+# Sources are the user's own scans and routinely exceed PIL's decompression bomb limit of about
+# 90 MP. PIL warns past this limit and refuses images over twice it, so files up to two gigapixels
+# (a 6 GB RGB raster) open while a corrupt or hostile header claiming more is still rejected.
+Image.MAX_IMAGE_PIXELS = 1024 ** 3
+
+MODELS = {
+    "Aura SR": "fal-ai/aura-sr",
+    "Creative Upscaler": "fal-ai/creative-upscaler",
+    "Lanczos (local, offline)": "local/lanczos"
+}
+
+# Arguments of every model: sent with each request to fal, besides the uploaded image_url, or
+# used by the local backend. They are part of the cache key either way.
+MODEL_ARGUMENTS = {
+    "fal-ai/aura-sr": {
+        "upscaling_factor": 4,
+        "checkpoint": "v2"
+    },
+    "fal-ai/creative-upscaler": {
+        "scale": 2,
+        "creativity": 0.1,
+        "detail": 1,
+        "shape_preservation": 0.25,
+        "prompt_suffix": " high quality, highly detailed, high resolution, sharp",
+        "negative_prompt": "blurry, low resolution, bad, ugly, low quality, pixelated, interpolated, compression artifacts, noisey, grainy",
+        "guidance_scale": 7.5,
+        "num_inference_steps": 20,
+        "enable_safety_checks": True,
+        "additional_lora_scale": 1
+    },
+    "local/lanczos": {
+        "scale": 4
+    }
+}
+
+DEFAULT_LINES = [0.25, 0.5, 0.75]
+
+# Input tile size each model handles efficiently, used by seamless tiled upscaling
+MODEL_TILE_SIZES = {
+    "fal-ai/aura-sr": 1024,
+    "fal-ai/creative-upscaler": 1024,
+    "local/lanczos": 1024
+}
+DEFAULT_TILE_OVERLAP = 32
+ATLAS_PADDING = 16  # Pixels of repeated edge around every tile packed into an atlas
+ATLAS_DIR = ".atlases"
+
+PREVIEW_MAX_SIZE = 2048
+# Decoded size past which a streamable source's preview is built a band at a time
+PREVIEW_STREAM_BYTES = 256 * 1024 ** 2
+PREVIEW_MIN_SIZE = 256
+
+AUTO_GRID_SAMPLES = 1024  # Columns sampled along each row, and rows along each column, by auto grid detection
+AUTO_GRID_TOLERANCE = 4.0  # Largest standard deviation (0-255) of any channel of a row or column that still counts as a gutter
+AUTO_GRID_MIN_CELL = 0.04  # Smallest detected cell, as a fraction of the side
+AUTO_GRID_MAX_CELLS = 16  # Most cells per side looked for when the cells have no gutters between them
+AUTO_GRID_SEAM_RATIO = 8.0  # How far above the typical row-to-row change a seam between cells has to stand out
+SEAMLESS_TILES_DIR = ".tiles"
+SEAMLESS_IMAGE_NAME = "upscaled_image.png"
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "CUTANDSCALE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "cutandscale", "upscaled")
+)
+DEFAULT_CACHE_SIZE = 2 * 1024 ** 3
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 3
+DOWNLOAD_BACKOFF = 1.0
+DOWNLOAD_TIMEOUT = (10, 60)  # Connect and read timeouts in seconds
+RETRY_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+QUEUE_POLL_INTERVAL = 0.5
+RUN_MANIFEST_FILE = ".run_manifest.json"
+TILE_ATTEMPTS = 3  # Attempts per tile before it is left for the next run
+TILE_RETRY_BACKOFF = 2.0
+RUN_REPORT_NAME = "run_report"  # Written as .json and .csv next to the upscaled tiles
+
+# Pipeline stages timed for every tile, in the order a tile goes through them
+TIMING_STAGES = ("encode", "upload", "queue", "inference", "download", "write")
+
+# Formats tiles can be exported in: PIL format, file extension and supported modes
+EXPORT_FORMATS = {
+    "JPEG": ("JPEG", "jpg", ("L", "RGB", "CMYK")),
+    "PNG": ("PNG", "png", ("1", "L", "LA", "P", "RGB", "RGBA")),
+    "WebP": ("WEBP", "webp", ("RGB", "RGBA")),
+    "TIFF": ("TIFF", "tif", ("1", "L", "LA", "P", "RGB", "RGBA", "CMYK")),
+}
+
+# Formats tiles can be uploaded in: PIL format, content type, save options and supported modes
+UPLOAD_FORMATS = {
+    "PNG": ("PNG", "image/png", {}, ("1", "L", "LA", "P", "RGB", "RGBA")),
+    "WebP": ("WEBP", "image/webp", {"lossless": True, "method": 4}, ("RGB", "RGBA")),
+}
+
+
+class TransientDownloadError(Exception):
+    pass
+
+
+class UpscaleCancelled(Exception):
+    pass
+
+
+class TileGrid:
+    # Crop boxes over a source image. Pixel data for a tile is only produced when
+    # it is asked for, so a cut costs the source image plus one tile at a time.
+    # With an overlap, every box extends that many pixels past its cut lines.
+    def __init__(self, image, h_pixels, v_pixels, overlap=0):
+        self.image = image
+        self.overlap = overlap
+        self.h_pixels = h_pixels
+        self.v_pixels = v_pixels
+        width, height = v_pixels[-1], h_pixels[-1]
+        self.boxes = [
+            [
+                (max(0, v_pixels[j] - overlap), max(0, h_pixels[i] - overlap),
+                 min(width, v_pixels[j + 1] + overlap), min(height, h_pixels[i + 1] + overlap))
+                for j in range(len(v_pixels) - 1)
+            ]
+            for i in range(len(h_pixels) - 1)
+        ]
+
+    @classmethod
+    def from_lines(cls, image, h_lines, v_lines):
+        h_pixels = [0] + [int(h * image.height) for h in h_lines] + [image.height]
+        v_pixels = [0] + [int(v * image.width) for v in v_lines] + [image.width]
+        return cls(image, h_pixels, v_pixels)
+
+    @classmethod
+    def for_tile_size(cls, image, tile_size, overlap=DEFAULT_TILE_OVERLAP):
+        # Even overlapping tiles no larger than tile_size, overlap included
+        step = max(1, tile_size - 2 * overlap)
+        rows = math.ceil(image.height / step)
+        cols = math.ceil(image.width / step)
+        h_pixels = [round(i * image.height / rows) for i in range(rows + 1)]
+        v_pixels = [round(j * image.width / cols) for j in range(cols + 1)]
+        return cls(image, h_pixels, v_pixels, overlap)
+
+    def __len__(self):
+        return sum(len(row) for row in self.boxes)
+
+    def box(self, index):
+        row, col = divmod(index, len(self.boxes[0]))
+        return self.boxes[row][col]
+
+    def tile(self, index):
+        return self.image.crop(self.box(index))
+
+    def tiles(self):
+        for index in range(len(self)):
+            yield self.tile(index)
+
+    def geometry(self):
+        return tuple(tuple(row) for row in self.boxes)
+
+
+def upscaled_tile_path(save_path, index, seamless=False):
+    # Tiles of a seamless run are intermediate files, kept aside until they are stitched
+    if seamless:
+        return os.path.join(save_path, SEAMLESS_TILES_DIR, f"tile_{index+1}.png")
+    return os.path.join(save_path, f"upscaled_image_{index+1}.jpg")
+
+
+def model_scale(model):
+    arguments = MODEL_ARGUMENTS[model]
+    return arguments.get("upscaling_factor") or arguments.get("scale") or 1
+
+
+def paste_padded(atlas, tile, x, y, padding):
+    # Paste tile with its outermost pixels repeated `padding` times around it, so the model
+    # sees no hard edge next to the tile and nothing of its neighbours bleeds into it
+    width, height = tile.size
+    atlas.paste(tile, (x, y))
+    if not padding:
+        return
+    atlas.paste(tile.crop((0, 0, width, 1)).resize((width, padding), Image.NEAREST), (x, y - padding))
+    atlas.paste(tile.crop((0, height - 1, width, height)).resize((width, padding), Image.NEAREST), (x, y + height))
+    left = atlas.crop((x, y - padding, x + 1, y + height + padding))
+    right = atlas.crop((x + width - 1, y - padding, x + width, y + height + padding))
+    atlas.paste(left.resize((padding, height + 2 * padding), Image.NEAREST), (x - padding, y - padding))
+    atlas.paste(right.resize((padding, height + 2 * padding), Image.NEAREST), (x + width, y - padding))
+
+
+class Atlas:
+    # Several small tiles of a grid packed into one image, so they are upscaled in a single
+    # request. positions are the top-left corners of the tiles themselves, inside their padding.
+    def __init__(self, indices, positions, size, padding=ATLAS_PADDING):
+        self.indices = indices
+        self.positions = positions
+        self.size = size
+        self.padding = padding
+
+    def compose(self, grid):
+        has_alpha = "A" in grid.image.getbands() or "transparency" in grid.image.info
+        mode = "RGBA" if has_alpha else "RGB"
+        atlas = Image.new(mode, self.size)
+        for index, (x, y) in zip(self.indices, self.positions):
+            paste_padded(atlas, grid.tile(index).convert(mode), x, y, self.padding)
+        return atlas
+
+    def slice(self, upscaled, grid):
+        # Yields (index, upscaled tile); the scale is taken from the result rather than assumed
+        scale_x = upscaled.width / self.size[0]
+        scale_y = upscaled.height / self.size[1]
+        for index, (x, y) in zip(self.indices, self.positions):
+            left, upper, right, lower = grid.box(index)
+            box = (round(x * scale_x), round(y * scale_y),
+                   round((x + right - left) * scale_x), round((y + lower - upper) * scale_y))
+            yield index, upscaled.crop(box)
+
+
+def pack_atlases(grid, atlas_size, padding=ATLAS_PADDING):
+    # Shelf-pack the tiles, tallest first, into atlases no larger than atlas_size. Returns the
+    # atlases and the indices of tiles left on their own: those too big to share an atlas, and
+    # any that would end up alone in one.
+    cells, singles = [], []
+    for index in range(len(grid)):
+        left, upper, right, lower = grid.box(index)
+        width, height = right - left + 2 * padding, lower - upper + 2 * padding
+        if width > atlas_size or height > atlas_size:
+            singles.append(index)
+        else:
+            cells.append((height, width, index))
+    cells.sort(key=lambda cell: (-cell[0], cell[2]))
+
+    packed = []
+    x = shelf_y = shelf_height = 0
+    for height, width, index in cells:
+        if not packed or (x + width > atlas_size and shelf_y + shelf_height + height > atlas_size):
+            packed.append([])
+            x = shelf_y = 0
+            shelf_height = height
+        elif x + width > atlas_size:
+            x, shelf_y, shelf_height = 0, shelf_y + shelf_height, height
+        packed[-1].append((index, x + padding, shelf_y + padding, width, height))
+        x += width
+
+    atlases = []
+    for placements in packed:
+        if len(placements) == 1:
+            singles.append(placements[0][0])
+            continue
+        size = (max(px - padding + width for _, px, _, width, _ in placements),
+                max(py - padding + height for _, _, py, _, height in placements))
+        atlases.append(Atlas([p[0] for p in placements], [(p[1], p[2]) for p in placements], size, padding))
+    return atlases, sorted(singles)
+
+
+class UpscaleJob:
+    # One upscale request: a single tile written straight to its output, or an atlas whose
+    # result is kept under ATLAS_DIR and sliced into the outputs of the tiles it holds
+    def __init__(self, indices, output_path, atlas=None):
+        self.indices = indices
+        self.output_path = output_path
+        self.atlas = atlas
+
+    def image(self, grid):
+        return self.atlas.compose(grid) if self.atlas else grid.tile(self.indices[0])
+
+    def finish(self, grid, save_path):
+        # Returns the bytes written for the tiles cut out of an atlas result
+        if self.atlas is None:
+            return 0
+        written = 0
+        with Image.open(self.output_path) as upscaled:
+            for index, tile in self.atlas.slice(upscaled, grid):
+                path = upscaled_tile_path(save_path, index)
+                convert_for_format(tile, EXPORT_FORMATS["JPEG"][2]).save(path, "JPEG", **export_options("JPEG", 100))
+                written += os.path.getsize(path)
+        return written
+
+
+def plan_jobs(grid, save_path, model, seamless=False, pack=False):
+    # Tiles of a seamless run are model-sized already, so only cut tiles are packed
+    if pack and not seamless:
+        atlases, singles = pack_atlases(grid, MODEL_TILE_SIZES[model])
+    else:
+        atlases, singles = [], range(len(grid))
+    jobs = [UpscaleJob([index], upscaled_tile_path(save_path, index, seamless)) for index in singles]
+    jobs += [
+        UpscaleJob(atlas.indices, os.path.join(save_path, ATLAS_DIR, f"atlas_{number + 1}.png"), atlas)
+        for number, atlas in enumerate(atlases)
+    ]
+    return jobs
+
+
+class PreviewPyramid:
+    # Downscaled copies of a source image, largest first, built once at load time.
+    # Displays resample from the nearest level instead of from the full image.
+    def __init__(self, image, max_size=PREVIEW_MAX_SIZE, min_size=PREVIEW_MIN_SIZE):
+        if image.mode not in ("L", "RGB", "RGBA"):
+            image = image.convert("RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB")
+        # reduce() is a cheap box filter for the integer part of the scale; LANCZOS does the rest
+        factor = int(max(image.size) / max_size)
+        top = image.reduce(factor) if factor > 1 else image.copy()
+        top.thumbnail((max_size, max_size), Image.LANCZOS)
+        self.levels = [top]
+        while min(self.levels[-1].size) >= 2 * min_size:
+            self.levels.append(self.levels[-1].reduce(2))
+
+    @classmethod
+    def for_image(cls, image, max_size=PREVIEW_MAX_SIZE, min_size=PREVIEW_MIN_SIZE):
+        # JPEG can be decoded straight at 1/2, 1/4 or 1/8 scale through a second handle, and large
+        # TIFF and PNG files that strips.py can read in bands are reduced band by band. Either way
+        # the full-resolution image stays undecoded until a cut needs it. Other images are decoded
+        # once and shared, which is quicker when the raster fits comfortably in memory.
+        path = getattr(image, "filename", None)
+        if image.format == "JPEG" and path:
+            with Image.open(path) as source:
+                source.draft("RGB", (max_size, max_size))
+                return cls(source, max_size, min_size)
+        if path and image.width * image.height * len(image.getbands()) > PREVIEW_STREAM_BYTES:
+            from strips import open_strips  # strips builds on this module
+
+            reader = open_strips(path, image)
+            if reader is not None:
+                return cls.from_bands(reader, image, max_size, min_size)
+        return cls(image, max_size, min_size)
+
+    @classmethod
+    def from_bands(cls, reader, image, max_size=PREVIEW_MAX_SIZE, min_size=PREVIEW_MIN_SIZE):
+        # reduce() each band into the top level. Bands needn't line up with the reduction factor,
+        # so rows left over at the bottom of one band are carried into the next.
+        from strips import STREAM_BAND_BYTES
+
+        mode = image.mode
+        if mode not in ("L", "RGB", "RGBA"):
+            mode = "RGBA" if "A" in image.getbands() or "transparency" in image.info else "RGB"
+        factor = max(1, int(max(image.size) / max_size))
+        rows = max(factor, STREAM_BAND_BYTES // (image.width * reader.pixel_bytes))
+        top = Image.new(mode, (math.ceil(image.width / factor), math.ceil(image.height / factor)))
+        carry, y = None, 0
+        for _, band in reader.bands(rows):
+            band = band.convert(mode)
+            if carry is not None:
+                merged = Image.new(mode, (band.width, carry.height + band.height))
+                merged.paste(carry, (0, 0))
+                merged.paste(band, (0, carry.height))
+                band = merged
+            usable = band.height // factor * factor
+            if usable:
+                top.paste(band.reduce(factor, (0, 0, band.width, usable)), (0, y))
+                y += usable // factor
+            carry = band.crop((0, usable, band.width, band.height)) if usable < band.height else None
+        if carry is not None:
+            top.paste(carry.reduce(factor), (0, y))
+        return cls(top, max_size, min_size)
+
+    @property
+    def size(self):
+        return self.levels[0].size
+
+    def level_for(self, size):
+        # Smallest level that still has at least as many pixels as the target, so we only ever downscale
+        width, height = size
+        for level in reversed(self.levels):
+            if level.width >= width or level.height >= height:
+                return level
+        return self.levels[0]
+
+    def resized(self, size):
+        return self.level_for(size).resize(size, Image.LANCZOS)
+
+    def fitted(self, size):
+        # Largest copy that fits in size while keeping the aspect ratio, never enlarged past the top level
+        scaled = self.level_for(size).copy()
+        scaled.thumbnail(size, Image.LANCZOS)
+        return scaled
+
+
+def grid_lines(count):
+    # Evenly spaced cut lines that split an axis into `count` parts
+    return [i / count for i in range(1, count)]
+
+
+def grid_pixels(image):
+    # RGB, plus alpha when there is one, as a (rows, columns, channels) array. Luminance alone
+    # would miss the boundary between cells of different hues but the same brightness.
+    import numpy as np
+
+    if image.mode in ("RGBA", "LA", "PA") or "transparency" in image.info:
+        return np.asarray(image.convert("RGBA"))
+    return np.asarray(image.convert("RGB"))
+
+
+def row_profiles(pixels, chunk=2048):
+    # How much each row varies across its width, and how much each row differs from the next.
+    # Worked through in chunks of rows to keep the float copies small on tall images.
+    import numpy as np
+
+    spread = np.empty(len(pixels), dtype=np.float32)
+    jump = np.empty(max(0, len(pixels) - 1), dtype=np.float32)
+    for start in range(0, len(pixels), chunk):
+        # Channels ahead of columns, so each channel's row is reduced over contiguous memory
+        block = pixels[start:start + chunk + 1].transpose(0, 2, 1).astype(np.float32, order="C")
+        spread[start:start + chunk] = block[:chunk].std(axis=2).max(axis=1)
+        jump[start:start + chunk] = np.abs(np.diff(block, axis=0)).mean(axis=(1, 2))
+    return spread, jump
+
+
+def runs(mask):
+    # (start, end) of every run of True values, end exclusive
+    import numpy as np
+
+    padded = np.concatenate(([False], mask, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    return list(zip(edges[::2].tolist(), edges[1::2].tolist()))
+
+
+def gutter_positions(spread, tolerance=AUTO_GRID_TOLERANCE, min_cell=AUTO_GRID_MIN_CELL):
+    # Cut through the middle of each run of rows flat enough to be a gutter. Stretches of content
+    # shorter than min_cell can't be a cell and count as flat, so smooth backgrounds hovering around
+    # the tolerance don't break up into gutters. Runs along the border are margins, and when two
+    # runs would leave a cell smaller than min_cell the wider one wins.
+    size = len(spread)
+    min_size = max(2, min_cell * size)
+    flat = spread <= tolerance
+    for start, end in runs(~flat):
+        if end - start < min_size:
+            flat[start:end] = True
+    gutters = [(start, end) for start, end in runs(flat) if start > 0 and end < size]
+    positions = []
+    for start, end in sorted(gutters, key=lambda run: run[0] - run[1]):
+        position = (start + end) // 2
+        if min(position, size - position) >= min_size and all(abs(position - p) >= min_size for p in positions):
+            positions.append(position)
+    return sorted(positions)
+
+
+def seam_positions(jump, max_cells=AUTO_GRID_MAX_CELLS, ratio=AUTO_GRID_SEAM_RATIO):
+    # Cells without gutters, like generated image grids, meet at sharp seams. Look for the largest
+    # even split whose every boundary has a seam standing out from the typical row-to-row change.
+    import numpy as np
+
+    size = len(jump) + 1
+    threshold = ratio * max(float(np.median(jump)), 0.5)
+    tolerance = max(1, size // 200)
+    best = []
+    for cells in range(2, max_cells + 1):
+        positions = []
+        for i in range(1, cells):
+            # jump[k] is the change between rows k and k + 1, so a cut at row p shows up at jump[p - 1]
+            expected = round(size * i / cells) - 1
+            low, high = max(0, expected - tolerance), min(len(jump), expected + tolerance + 1)
+            peak = low + int(np.argmax(jump[low:high]))
+            if jump[peak] < threshold:
+                break
+            positions.append(peak + 1)
+        else:
+            best = positions
+    return best
+
+
+def detect_cuts(pixels, tolerance=AUTO_GRID_TOLERANCE):
+    # Cut rows along the first axis of pixels: gutters when there are any, seams otherwise
+    spread, jump = row_profiles(pixels)
+    return gutter_positions(spread, tolerance) or seam_positions(jump)
+
+
+def detect_grid_lines(image, tolerance=AUTO_GRID_TOLERANCE, samples=AUTO_GRID_SAMPLES):
+    # Find the gutters or seams between the cells of a sprite sheet, contact sheet or image grid.
+    # Returns (h_lines, v_lines) as fractions; an axis with nothing found gets an empty list.
+    # Every row is profiled at full resolution, but only across `samples` evenly picked columns
+    # (and the other way round), which keeps even 1-2 px gutters exact on very large images.
+    rows = image.resize((min(image.width, samples), image.height), Image.NEAREST)
+    columns = image.resize((image.width, min(image.height, samples)), Image.NEAREST)
+    h_cuts = detect_cuts(grid_pixels(rows), tolerance)
+    v_cuts = detect_cuts(grid_pixels(columns).transpose(1, 0, 2), tolerance)
+    # Half a pixel past each cut so int(fraction * side) in TileGrid.from_lines lands on the cut row
+    return [(y + 0.5) / image.height for y in h_cuts], [(x + 0.5) / image.width for x in v_cuts]
+
+
+def convert_for_format(image, modes):
+    if image.mode in modes:
+        return image
+    has_alpha = "A" in image.getbands() or "transparency" in image.info
+    return image.convert("RGBA" if has_alpha and "RGBA" in modes else "RGB")
+
+
+def export_options(export_format, quality):
+    # Quality only applies to the lossy formats; WebP at 100 is saved losslessly
+    if export_format == "JPEG":
+        return {"quality": quality, "subsampling": 0}
+    if export_format == "WebP":
+        return {"lossless": True} if quality >= 100 else {"quality": quality}
+    if export_format == "TIFF":
+        return {"compression": "tiff_lzw"}
+    return {}
+
+
+def save_tile(grid, index, save_path, export_format="JPEG", quality=100):
+    return write_tile(grid.tile(index), index, save_path, export_format, quality)
+
+
+def write_tile(tile, index, save_path, export_format="JPEG", quality=100):
+    pil_format, extension, modes = EXPORT_FORMATS[export_format]
+    path = os.path.join(save_path, f"split_image_{index+1}.{extension}")
+    img = convert_for_format(tile, modes)
+    img.save(path, format=pil_format, **export_options(export_format, quality))
+    return path
+
+
+def save_tiles(grid, save_path, export_format="JPEG", quality=100, workers=None, progress=None):
+    # Crop, encode and write tiles in parallel; PIL releases the GIL while it encodes.
+    # progress(done) is called from the calling thread after each tile is written.
+    paths = [None] * len(grid)
+    grid.image.load()  # Decode once up front rather than racing to do it from the worker threads
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        futures = {
+            executor.submit(save_tile, grid, index, save_path, export_format, quality): index
+            for index in range(len(grid))
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            paths[futures[future]] = future.result()
+            if progress:
+                progress(done)
+    return paths
+
+
+def png_chunk(kind, data):
+    # Length, type, data and the CRC of type and data
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+class PngStreamWriter:
+    # Writes an RGB PNG strip by strip, so the full image never has to be in memory
+    def __init__(self, path, width, height):
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.compressor = zlib.compressobj(6)
+        self.file = open(path, "wb")
+        self.file.write(b"\x89PNG\r\n\x1a\n")
+        self.write_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+
+    def write_chunk(self, kind, data):
+        self.file.write(png_chunk(kind, data))
+
+    def write(self, strip):
+        # Every scanline is prefixed with filter type 0 (none)
+        data = strip.convert("RGB").tobytes()
+        stride = self.width * 3
+        raw = b"".join(b"\x00" + data[row * stride:(row + 1) * stride] for row in range(strip.height))
+        compressed = self.compressor.compress(raw)
+        if compressed:
+            self.write_chunk(b"IDAT", compressed)
+        self.rows_written += strip.height
+
+    def close(self):
+        self.write_chunk(b"IDAT", self.compressor.flush())
+        self.write_chunk(b"IEND", b"")
+        self.file.close()
+        if self.rows_written != self.height:
+            raise Exception(f"PNG incomplete: wrote {self.rows_written} of {self.height} rows")
+
+
+def feather_mask(size, left=0, top=0):
+    # Opaque mask whose first `left` columns (or `top` rows) ramp up from transparent,
+    # so pasting through it cross-fades the overlap with what is already there
+    width, height = size
+    mask = Image.new("L", size, 255)
+    if left:
+        ramp = bytes(int(255 * (x + 0.5) / left) for x in range(left))
+        mask.paste(Image.frombytes("L", (left, 1), ramp).resize((left, height), Image.NEAREST), (0, 0))
+    if top:
+        ramp = bytes(int(255 * (y + 0.5) / top) for y in range(top))
+        mask.paste(Image.frombytes("L", (1, top), ramp).resize((width, top), Image.NEAREST), (0, 0))
+    return mask
+
+
+def stitch_tiles(grid, tile_paths, output_path, log=logging.info):
+    # Feather-blend the upscaled tiles of an overlapping grid into one PNG. Only one
+    # row band of tiles plus the overlap carried into the next band is held in memory.
+    rows, cols = len(grid.boxes), len(grid.boxes[0])
+    with Image.open(tile_paths[0]) as first:
+        first_box = grid.boxes[0][0]
+        scale = round(first.width / (first_box[2] - first_box[0]))
+    width, height = grid.v_pixels[-1] * scale, grid.h_pixels[-1] * scale
+    log(f"Stitching {len(grid)} tiles into {width}x{height} at {scale}x")
+
+    writer = PngStreamWriter(output_path, width, height)
+    try:
+        carry = None
+        for i in range(rows):
+            band_top, band_bottom = grid.boxes[i][0][1] * scale, grid.boxes[i][0][3] * scale
+            band = Image.new("RGB", (width, band_bottom - band_top))
+            previous_right = 0
+            for j in range(cols):
+                left, upper, right, lower = (value * scale for value in grid.boxes[i][j])
+                with Image.open(tile_paths[i * cols + j]) as tile:
+                    tile = tile.convert("RGB")
+                if tile.size != (right - left, lower - upper):
+                    # Some models round their output size; fit the tile to its slot
+                    tile = tile.resize((right - left, lower - upper), Image.LANCZOS)
+                band.paste(tile, (left, 0), feather_mask(tile.size, left=max(0, previous_right - left)))
+                previous_right = right
+
+            # Blend the top of this band into the bottom of the previous one
+            top_overlap = carry.height if carry is not None else 0
+            if carry is not None:
+                top = band.crop((0, 0, width, top_overlap))
+                carry.paste(top, (0, 0), feather_mask(top.size, top=top_overlap))
+                writer.write(carry)
+            bottom_overlap = band_bottom - grid.boxes[i + 1][0][1] * scale if i + 1 < rows else 0
+            writer.write(band.crop((0, top_overlap, width, band.height - bottom_overlap)))
+            carry = band.crop((0, band.height - bottom_overlap, width, band.height)) if bottom_overlap else None
+    finally:
+        writer.close()
+    log(f"Saved {output_path}")
+    return output_path
+
+
+def tile_key(image, model, arguments):
+    # Content address of an upscale job: the input pixels, the model and its arguments
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.width}x{image.height}:{model}:".encode())
+    digest.update(json.dumps(arguments, sort_keys=True).encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class UpscaleCache:
+    # Upscaled results on disk, addressed by a hash of the input pixels, the model and its
+    # arguments. Entries are evicted least recently used first once the size cap is exceeded.
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_size=DEFAULT_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size = sum(entry.stat().st_size for entry in os.scandir(cache_dir) if entry.is_file())
+
+    def contains(self, key):
+        return os.path.exists(os.path.join(self.cache_dir, key))
+
+    def fetch(self, key, dest_path):
+        path = os.path.join(self.cache_dir, key)
+        try:
+            shutil.copyfile(path, dest_path)
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, src_path):
+        # Copy under a temporary name first so a concurrent fetch never sees a partial entry
+        fd, temp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".tmp-")
+        os.close(fd)
+        shutil.copyfile(src_path, temp_path)
+        os.replace(temp_path, os.path.join(self.cache_dir, key))
+        with self.lock:
+            self.size += os.path.getsize(src_path)
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        entries = sorted(
+            (entry for entry in os.scandir(self.cache_dir) if entry.is_file() and not entry.name.startswith(".tmp-")),
+            key=lambda entry: entry.stat().st_mtime
+        )
+        self.size = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if self.size <= self.max_size:
+                break
+            try:
+                self.size -= entry.stat().st_size
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+
+    def summary(self):
+        return f"Cache: {self.hits} hits, {self.misses} misses"
+
+
+def create_session(pool_size=4):
+    # One session per run, so every download reuses pooled connections instead of a new TCP/TLS handshake
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def stream_to_file(session, url, dest_path, timings=None):
+    # Stream the body to a temp file next to the destination and rename it into place when complete.
+    # Time spent writing to disk is recorded as the write stage, the rest as the download.
+    start = time.perf_counter()
+    write_seconds = 0
+    with session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+        if response.status_code in RETRY_STATUS_CODES:
+            raise TransientDownloadError(f"Download failed. Status code: {response.status_code}")
+        if response.status_code != 200:
+            raise Exception(f"Download failed. Status code: {response.status_code}")
+
+        # With a Content-Encoding the header counts compressed bytes, which can't be compared
+        expected_size = response.headers.get("Content-Length")
+        if response.headers.get("Content-Encoding"):
+            expected_size = None
+
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path) or ".", prefix=".download-")
+        size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    write_start = time.perf_counter()
+                    f.write(chunk)
+                    write_seconds += time.perf_counter() - write_start
+                    size += len(chunk)
+            if expected_size is not None and size != int(expected_size):
+                raise TransientDownloadError(f"Download incomplete: received {size} of {expected_size} bytes")
+            os.replace(temp_path, dest_path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    if timings is not None:
+        timings.add("download", time.perf_counter() - start - write_seconds, size)
+        timings.add("write", write_seconds, size)
+    return size
+
+
+def download_file(url, dest_path, session=None, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF, log=logging.info,
+                  timings=None):
+    # Returns the number of bytes written. Connection errors, truncated bodies and
+    # retryable status codes are retried with exponential backoff.
+    import requests
+
+    session = session or requests.Session()
+    for attempt in range(retries + 1):
+        try:
+            return stream_to_file(session, url, dest_path, timings)
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError,
+                TransientDownloadError) as e:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            log(f"Download attempt {attempt + 1} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+class Prefetcher:
+    # Runs func(index) on background threads, staying up to `lookahead` indexes ahead of
+    # the consumer, so preparing the next tile overlaps with the upload of the current one
+    def __init__(self, func, count, lookahead=1, workers=1):
+        self.func = func
+        self.count = count
+        self.lookahead = lookahead
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.futures = {}
+        self.next_index = 0
+        self.lock = threading.Lock()
+
+    def get(self, index):
+        with self.lock:
+            while self.next_index < min(self.count, index + self.lookahead + 1):
+                self.futures[self.next_index] = self.executor.submit(self.func, self.next_index)
+                self.next_index += 1
+            future = self.futures.pop(index)
+        return future.result()
+
+    def close(self):
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures.clear()
+        self.executor.shutdown(wait=True)
+
+
+def encode_image(image, image_format="PNG"):
+    # Returns the encoded bytes and their content type
+    pil_format, content_type, options, modes = UPLOAD_FORMATS[image_format]
+    image = convert_for_format(image, modes)
+    buffer = io.BytesIO()
+    image.save(buffer, format=pil_format, **options)
+    return buffer.getvalue(), content_type
+
+
+class RunManifest:
+    # State of every tile of an upscale run, saved next to the outputs. A stopped or failed
+    # run resumes from it: finished tiles are skipped and submitted requests are collected
+    # instead of paid for again. Entries are keyed by the output path relative to save_path.
+    def __init__(self, save_path):
+        self.save_path = save_path
+        self.path = os.path.join(save_path, RUN_MANIFEST_FILE)
+        self.lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.tiles = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.tiles = {}
+
+    def name_for(self, path):
+        return os.path.relpath(path, self.save_path)
+
+    def entry(self, name, key):
+        # Only entries made for the same pixels, model and arguments count
+        entry = self.tiles.get(name)
+        return entry if entry and entry["key"] == key else None
+
+    def is_done(self, name, key):
+        entry = self.entry(name, key)
+        path = os.path.join(self.save_path, name)
+        return (entry is not None and entry["state"] == "done" and os.path.exists(path)
+                and os.path.getsize(path) == entry["size"])
+
+    def request_id(self, name, key):
+        # Submitted requests, and failed tiles that got as far as submitting, can be collected
+        entry = self.entry(name, key)
+        return entry.get("request_id") if entry and entry["state"] in ("submitted", "failed") else None
+
+    def update(self, name, key, model, state, **fields):
+        with self.lock:
+            previous = self.entry(name, key) or {}
+            attempts = previous.get("attempts", 0) + (state == "failed")
+            self.tiles[name] = {"key": key, "model": model, "state": state, "attempts": attempts, **fields}
+            self.save()
+
+    def submitted(self, name, key, model, request_id):
+        self.update(name, key, model, "submitted", request_id=request_id)
+
+    def done(self, name, key, model, size):
+        self.update(name, key, model, "done", size=size)
+
+    def failed(self, name, key, model, error):
+        request_id = self.request_id(name, key)
+        fields = {"request_id": request_id} if request_id else {}
+        self.update(name, key, model, "failed", error=error, **fields)
+
+    def forget(self, names):
+        with self.lock:
+            for name in names:
+                self.tiles.pop(name, None)
+            self.save()
+
+    def save(self):
+        if not self.tiles:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.tiles, f, indent=2)
+        os.replace(temp_path, self.path)
+
+
+def is_retryable(error):
+    # Network trouble and server-side failures are worth another attempt; bad requests,
+    # missing credentials and a stopped run are not
+    import fal_client
+    import httpx
+    import requests
+
+    if isinstance(error, UpscaleCancelled):
+        return False
+    if isinstance(error, fal_client.FalClientHTTPError):
+        return error.status_code in RETRY_STATUS_CODES or error.status_code >= 500
+    return isinstance(error, (TransientDownloadError, requests.RequestException, httpx.TransportError,
+                              ConnectionError, TimeoutError))
+
+
+class RetryPolicy:
+    # How many times a tile is attempted in one run and how long to wait between attempts
+    def __init__(self, attempts=TILE_ATTEMPTS, backoff=TILE_RETRY_BACKOFF, retryable=is_retryable):
+        self.attempts = max(1, attempts)
+        self.backoff = backoff
+        self.retryable = retryable
+
+    def should_retry(self, error, attempt):
+        return attempt < self.attempts and self.retryable(error)
+
+    def delay(self, attempt):
+        return self.backoff * 2 ** (attempt - 1)
+
+
+class TileTimings:
+    # Wall time and bytes per pipeline stage for one tile. A stage can be recorded more than
+    # once (a retried download, a result copied into the cache), so the totals accumulate.
+    def __init__(self, index=0, label=None):
+        self.index = index
+        self.label = label  # Shown instead of the index, e.g. for an atlas of several tiles
+        self.source = None  # "cache", "resumed", "upscaled" or "skipped" once the tile is done
+        self.stages = {}
+
+    def add(self, stage, seconds, size=0):
+        total_seconds, total_bytes = self.stages.get(stage, (0, 0))
+        self.stages[stage] = (total_seconds + seconds, total_bytes + size)
+
+    @contextmanager
+    def span(self, stage, size=0):
+        # Yields a dict whose "bytes" can be filled in when the size is only known afterwards
+        span = {"bytes": size}
+        start = time.perf_counter()
+        try:
+            yield span
+        finally:
+            self.add(stage, time.perf_counter() - start, span["bytes"])
+
+    def as_dict(self):
+        row = {"tile": self.label or self.index + 1, "source": self.source}
+        for stage in TIMING_STAGES:
+            seconds, size = self.stages.get(stage, (0, 0))
+            row[f"{stage}_ms"] = round(seconds * 1000, 1)
+            row[f"{stage}_bytes"] = size
+        row["total_ms"] = round(sum(seconds for seconds, _ in self.stages.values()) * 1000, 1)
+        return row
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile of a non-empty list
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+class RunReport:
+    # Collects the TileTimings of one upscale run and writes them out as JSON and CSV
+    def __init__(self, count, model, image_format="PNG", concurrency=1):
+        self.tiles = [TileTimings(i) for i in range(count)]
+        self.model = model
+        self.image_format = image_format
+        self.concurrency = concurrency
+        self.started = time.time()
+        self.start = time.perf_counter()
+        self.wall_seconds = None
+
+    def tile(self, index):
+        return self.tiles[index]
+
+    def finish(self):
+        self.wall_seconds = time.perf_counter() - self.start
+
+    def stage_summary(self):
+        # p50/p95 in milliseconds and total bytes per stage, over the requests that went through it.
+        # With packing a request is an atlas of several tiles, so these count requests.
+        summary = {}
+        for stage in TIMING_STAGES:
+            recorded = [tile.stages[stage] for tile in self.tiles if stage in tile.stages]
+            if not recorded:
+                continue
+            milliseconds = [seconds * 1000 for seconds, _ in recorded]
+            summary[stage] = {
+                "requests": len(recorded),
+                "p50_ms": round(percentile(milliseconds, 0.5), 1),
+                "p95_ms": round(percentile(milliseconds, 0.95), 1),
+                "bytes": sum(size for _, size in recorded)
+            }
+        return summary
+
+    def summary_lines(self):
+        lines = []
+        for stage, stats in self.stage_summary().items():
+            line = f"{stage:<9} p50 {stats['p50_ms']:8.1f} ms  p95 {stats['p95_ms']:8.1f} ms  ({stats['requests']} requests"
+            if stats["bytes"]:
+                line += f", {stats['bytes'] / 1e6:.1f} MB"
+            lines.append(line + ")")
+        if self.wall_seconds is not None:
+            lines.append(f"{len(self.tiles)} requests in {self.wall_seconds:.2f} s")
+        return lines
+
+    def save(self, save_path):
+        # Returns the path of the JSON report; the CSV has one row per tile
+        rows = [tile.as_dict() for tile in self.tiles]
+        report = {
+            "model": self.model,
+            "upload_format": self.image_format,
+            "concurrency": self.concurrency,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "wall_seconds": round(self.wall_seconds, 3) if self.wall_seconds is not None else None,
+            "stages": self.stage_summary(),
+            "tiles": rows
+        }
+        json_path = os.path.join(save_path, RUN_REPORT_NAME + ".json")
+        with open(json_path, "w") as f:
+            json.dump(report, f, indent=2)
+        with open(os.path.join(save_path, RUN_REPORT_NAME + ".csv"), "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0]) if rows else ["tile"])
+            writer.writeheader()
+            writer.writerows(rows)
+        return json_path
+
+
+def wait_for_result(model, request_id, log=logging.info, is_running=lambda: True, interval=None,
+                    timings=None):
+    # Poll the queue until the request completes, passing queue position and model logs to log().
+    # Time until the request leaves the queue counts as the queue stage, the rest as inference.
+    # Both are only as precise as the poll interval, unless the server reports its inference time.
+    import fal_client
+
+    interval = QUEUE_POLL_INTERVAL if interval is None else interval
+    last_position = None
+    logs_index = 0
+    start = time.perf_counter()
+    started_inference = None
+    while True:
+        if not is_running():
+            raise UpscaleCancelled(f"Stopped while waiting for request {request_id}")
+        status = fal_client.status(model, request_id, with_logs=True)
+        if isinstance(status, fal_client.Queued):
+            if status.position != last_position:
+                log(f"Queued, position {status.position}")
+                last_position = status.position
+        elif isinstance(status, (fal_client.InProgress, fal_client.Completed)):
+            if started_inference is None:
+                started_inference = time.perf_counter()
+            for entry in (status.logs or [])[logs_index:]:
+                log(entry["message"])
+            logs_index = len(status.logs or [])
+            if isinstance(status, fal_client.Completed):
+                result = fal_client.result(model, request_id)
+                if timings is not None:
+                    waited = time.perf_counter() - start
+                    inference = (status.metrics or {}).get("inference_time")
+                    if inference is None or not 0 <= inference <= waited:
+                        inference = time.perf_counter() - started_inference
+                    timings.add("queue", waited - inference)
+                    timings.add("inference", inference)
+                return result
+        time.sleep(interval)
+
+
+class FalBackend:
+    # A model on fal's queue: tiles are uploaded and submitted, and the result is downloaded once
+    # the request completes. Requests outlive the run, so results are cached and a stopped run
+    # collects the requests it submitted instead of paying for them again.
+    remote = True
+    concurrency = None  # In-flight requests are only limited by the Parallel setting
+
+    def __init__(self, model):
+        self.model = model
+
+    def encode(self, image, image_format):
+        return encode_image(image, image_format)
+
+    def submit(self, image, encoded, log, timings):
+        import fal_client
+
+        data, content_type = encoded
+        log(f"Uploading {len(data) / 1024:.0f} KB")
+        with timings.span("upload", len(data)):
+            image_url = fal_client.upload(data, content_type)
+        request_id = fal_client.submit(self.model, arguments={"image_url": image_url, **MODEL_ARGUMENTS[self.model]}).request_id
+        log(f"Submitted request {request_id}")
+        return request_id
+
+    def result(self, request_id, log, is_running, timings):
+        return wait_for_result(self.model, request_id, log, is_running, timings=timings)
+
+    def fetch(self, result, dest_path, session, log, timings):
+        log("Downloading")
+        return download_file(result["image"]["url"], dest_path, session=session, log=log, timings=timings)
+
+
+class LocalBackend:
+    # Resamples tiles on this machine: free, offline and quick, for previews before paying for
+    # a remote model. It is CPU bound, so no more tiles run at once than there are cores, and
+    # results are not cached since redoing them is about as cheap as copying them.
+    remote = False
+
+    def __init__(self, model, resample=Image.LANCZOS):
+        self.model = model
+        self.resample = resample
+        self.concurrency = os.cpu_count() or 1
+
+    def encode(self, image, image_format):
+        return None  # Nothing is uploaded
+
+    def submit(self, image, encoded, log, timings):
+        return image
+
+    def result(self, image, log, is_running, timings):
+        scale = model_scale(self.model)
+        with timings.span("inference"):
+            image = convert_for_format(image, ("L", "RGB", "RGBA"))
+            return image.resize((image.width * scale, image.height * scale), self.resample)
+
+    def fetch(self, upscaled, dest_path, session, log, timings):
+        # Written in the format the output name asks for, under a temporary name until complete
+        export_format = next(name for name, (_, extension, _) in EXPORT_FORMATS.items()
+                             if dest_path.endswith(f".{extension}"))
+        pil_format, _, modes = EXPORT_FORMATS[export_format]
+        temp_path = f"{dest_path}.part"
+        with timings.span("write") as span:
+            convert_for_format(upscaled, modes).save(temp_path, pil_format, **export_options(export_format, 100))
+            os.replace(temp_path, dest_path)
+            span["bytes"] = os.path.getsize(dest_path)
+        return span["bytes"]
+
+
+# Every model an upscale can be routed to, by the id MODELS maps its display name to
+BACKENDS = {
+    "fal-ai/aura-sr": FalBackend("fal-ai/aura-sr"),
+    "fal-ai/creative-upscaler": FalBackend("fal-ai/creative-upscaler"),
+    "local/lanczos": LocalBackend("local/lanczos", Image.LANCZOS),
+}
+
+
+def backend_concurrency(model, concurrency):
+    # Tiles in flight for a run: what was asked for, within the backend's own limit
+    limit = BACKENDS[model].concurrency
+    return max(1, min(concurrency, limit) if limit else concurrency)
+
+
+def prepare_tile(image, model, image_format="PNG", cache=None, timings=None, manifest=None, upscaled_img_path=None):
+    # Hash and encode one tile ahead of its upload. Tiles that are already cached or were
+    # finished by an earlier run are not encoded, since they won't be uploaded.
+    key = tile_key(image, model, MODEL_ARGUMENTS[model])
+    if cache is not None and cache.contains(key):
+        return image, key, None
+    if manifest is not None and manifest.is_done(manifest.name_for(upscaled_img_path), key):
+        return image, key, None
+    start = time.perf_counter()
+    encoded = BACKENDS[model].encode(image, image_format)
+    if timings is not None and encoded is not None:
+        timings.add("encode", time.perf_counter() - start, len(encoded[0]))
+    return image, key, encoded
+
+
+def upscale_tile(prepared, upscaled_img_path, model, image_format="PNG", log=logging.info, cache=None, session=None,
+                 manifest=None, is_running=lambda: True, timings=None, retry=None):
+    # Upscale one prepared tile, attempting it again as the retry policy allows. A tile that
+    # still fails is marked failed in the manifest so the next run picks it up.
+    key = prepared[1]
+    retry = retry or RetryPolicy(attempts=1)
+    attempt = 1
+    while True:
+        try:
+            return attempt_upscale(prepared, upscaled_img_path, model, image_format, log, cache, session, manifest,
+                                   is_running, timings)
+        except UpscaleCancelled:
+            raise
+        except Exception as e:
+            if not retry.should_retry(e, attempt) or not is_running():
+                if manifest is not None:
+                    manifest.failed(manifest.name_for(upscaled_img_path), key, model, str(e))
+                raise
+            delay = retry.delay(attempt)
+            log(f"Attempt {attempt} failed ({e}), retrying in {delay:.0f}s")
+            deadline = time.monotonic() + delay
+            while time.monotonic() < deadline:
+                if not is_running():
+                    raise UpscaleCancelled("Stopped before retrying")
+                time.sleep(min(0.1, deadline - time.monotonic()))
+            attempt += 1
+
+
+def attempt_upscale(prepared, upscaled_img_path, model, image_format="PNG", log=logging.info, cache=None, session=None,
+                    manifest=None, is_running=lambda: True, timings=None):
+    # Send one prepared tile to the model's backend, wait for the result and write it to
+    # upscaled_img_path. Returns the size of the written result in bytes.
+    image, key, encoded = prepared
+    backend = BACKENDS[model]
+    cache = cache if backend.remote else None
+    timings = timings if timings is not None else TileTimings()
+    name = manifest.name_for(upscaled_img_path) if manifest is not None else None
+    if manifest is not None and manifest.is_done(name, key):
+        timings.source = "skipped"
+        log("Already upscaled by an earlier run, skipping")
+        return os.path.getsize(upscaled_img_path)
+
+    start = time.perf_counter()
+    if cache is not None and cache.fetch(key, upscaled_img_path):
+        size = os.path.getsize(upscaled_img_path)
+        timings.add("write", time.perf_counter() - start, size)
+        timings.source = "cache"
+        if manifest is not None:
+            manifest.done(name, key, model, size)
+        log("Cache hit")
+        return size
+
+    request_id = manifest.request_id(name, key) if manifest is not None and backend.remote else None
+    result = None
+    size = None
+    if request_id:
+        import fal_client
+
+        log(f"Resuming request {request_id}")
+        try:
+            result = backend.result(request_id, log, is_running, timings)
+            timings.source = "resumed"
+        except fal_client.FalClientHTTPError as e:
+            # The request expired or failed on the server side; submit it again
+            log(f"Could not resume request {request_id} ({e}), submitting again")
+        if result is not None:
+            try:
+                size = backend.fetch(result, upscaled_img_path, session, log, timings)
+            except Exception as e:
+                if isinstance(e, UpscaleCancelled) or is_retryable(e):
+                    raise
+                # The result URL of an old request can expire; collecting it again would fail the
+                # same way on every later run, so the tile is submitted afresh
+                log(f"Could not download the result of request {request_id} ({e}), submitting again")
+                result = None
+
+    if result is None:
+        if encoded is None and backend.remote:
+            # The cache entry was evicted after the tile was prepared
+            with timings.span("encode") as span:
+                encoded = backend.encode(image, image_format)
+                span["bytes"] = len(encoded[0])
+        handle = backend.submit(image, encoded, log, timings)
+        timings.source = "upscaled"
+        if manifest is not None and backend.remote:
+            manifest.submitted(name, key, model, handle)
+        result = backend.result(handle, log, is_running, timings)
+        size = backend.fetch(result, upscaled_img_path, session, log, timings)
+    if cache is not None:
+        with timings.span("write", size):
+            cache.store(key, upscaled_img_path)
+    if manifest is not None:
+        manifest.done(name, key, model, size)
+    log("Saved")
+    return size
+
+
+class UpscaleRun:
+    # One upscale of a grid into save_path, as run by the GUI and by batch mode. Tiles are
+    # prepared on prefetch threads just ahead of their upload and requests are submitted in
+    # order, at most `concurrency` in flight. A tile that fails after its retries doesn't stop
+    # the others; the manifest lets the next run into save_path redo only the missing ones.
+    def __init__(self, grid, save_path, model, concurrency=4, cache=None, image_format="PNG", seamless=False,
+                 pack=False, retry=None, session=None, prefetch_workers=None, log=logging.info):
+        self.grid = grid
+        self.save_path = save_path
+        self.model = model
+        # The backend may run fewer tiles at once than asked for, e.g. one per core when local
+        self.concurrency = backend_concurrency(model, concurrency)
+        self.cache = cache if BACKENDS[model].remote else None
+        self.image_format = image_format
+        self.seamless = seamless
+        self.retry = retry or RetryPolicy()
+        self.session = session
+        self.prefetch_workers = prefetch_workers or min(self.concurrency, os.cpu_count() or 1)
+        self.log = log
+        self.jobs = plan_jobs(grid, save_path, model, seamless, pack)
+        self.atlases = [job for job in self.jobs if job.atlas]
+        self.report = RunReport(len(self.jobs), model, image_format, self.concurrency)
+        for number, job in enumerate(self.atlases):
+            self.report.tile(self.jobs.index(job)).label = f"atlas {number + 1} ({len(job.indices)} tiles)"
+        self.manifest = None
+        self.prefetcher = None
+        self.futures = []
+        self.written = [0] * len(self.jobs)  # Bytes written and uploaded by each request in this run
+        self.uploaded = [0] * len(self.jobs)
+        self.is_running = True
+
+    def run(self, progress=None):
+        # progress(j, status) is called from the request threads with "Starting" and "Completed"
+        # for each request. Returns the stitched image of a seamless run. Raises once the other
+        # tiles are done if any failed, and does nothing more when stopped.
+        # Tiles are cropped on the prefetch threads; a lazily opened source (JPEGs are only
+        # decoded at preview scale on load) is decoded once here rather than by each of them
+        self.grid.image.load()
+        self.manifest = RunManifest(self.save_path)
+        if self.atlases:
+            os.makedirs(os.path.join(self.save_path, ATLAS_DIR), exist_ok=True)
+            self.log(f"Packed {sum(len(job.indices) for job in self.atlases)} tiles into {len(self.atlases)} atlases, "
+                     f"{len(self.jobs)} requests for {len(self.grid)} tiles")
+        if self.seamless:
+            os.makedirs(os.path.join(self.save_path, SEAMLESS_TILES_DIR), exist_ok=True)
+        session = self.session or create_session(self.concurrency)
+        self.prefetcher = Prefetcher(
+            lambda j: prepare_tile(self.jobs[j].image(self.grid), self.model, self.image_format, self.cache,
+                                   self.report.tile(j), self.manifest, self.jobs[j].output_path),
+            len(self.jobs), lookahead=self.concurrency, workers=self.prefetch_workers
+        )
+        failed = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                self.futures = [executor.submit(self.upscale, j, session, progress) for j in range(len(self.jobs))]
+                if not self.is_running:
+                    self.cancel_pending()
+                for j, future in enumerate(self.futures):
+                    try:
+                        future.result()
+                    except (CancelledError, UpscaleCancelled):
+                        continue
+                    except Exception as e:
+                        failed.append((len(self.jobs[j].indices), e))
+        finally:
+            self.prefetcher.close()
+            if session is not self.session:
+                session.close()
+            self.report.finish()
+            self.write_report()
+
+        skipped = sum(tile.source == "skipped" for tile in self.report.tiles)
+        if skipped:
+            self.log(f"Skipped {skipped} requests finished by an earlier run")
+        if failed:
+            raise Exception(f"{sum(count for count, _ in failed)} of {len(self.grid)} tiles failed ({failed[0][1]}). "
+                            f"The finished tiles are kept; upscale into the same folder again to retry only the "
+                            f"missing ones.")
+        if not self.is_running:
+            return None
+
+        if self.atlases:
+            # Atlas results are only kept so a resumed run can slice them again
+            shutil.rmtree(os.path.join(self.save_path, ATLAS_DIR))
+            self.manifest.forget(self.manifest.name_for(job.output_path) for job in self.atlases)
+
+        if not self.seamless:
+            return None
+        tile_paths = [upscaled_tile_path(self.save_path, i, seamless=True) for i in range(len(self.grid))]
+        try:
+            output_path = stitch_tiles(self.grid, tile_paths, os.path.join(self.save_path, SEAMLESS_IMAGE_NAME),
+                                       log=self.log)
+        except Exception as e:
+            raise Exception(f"Stitching failed: {e}") from e
+        shutil.rmtree(os.path.join(self.save_path, SEAMLESS_TILES_DIR))
+        self.manifest.forget(self.manifest.name_for(path) for path in tile_paths)
+        return output_path
+
+    def upscale(self, j, session, progress):
+        if not self.is_running:
+            return
+        job = self.jobs[j]
+        timings = self.report.tile(j)
+        name = f"Image {job.indices[0] + 1}" if job.atlas is None else timings.label.capitalize()
+        if progress:
+            progress(j, "Starting")
+        try:
+            prepared = self.prefetcher.get(j)
+            self.uploaded[j] = len(prepared[2][0]) if prepared[2] is not None else 0
+            # Output names follow the tile index, so results keep their grid order
+            size = upscale_tile(
+                prepared, job.output_path, self.model, self.image_format,
+                log=lambda message: self.log(f"{name}: {message}"), cache=self.cache, session=session,
+                manifest=self.manifest, is_running=lambda: self.is_running, timings=timings, retry=self.retry
+            )
+            if timings.source != "skipped":
+                self.written[j] = size  # A result left by an earlier run isn't written again
+            if job.atlas is not None:
+                with timings.span("write") as span:
+                    span["bytes"] = job.finish(self.grid, self.save_path)
+                self.written[j] += span["bytes"]
+        except UpscaleCancelled:
+            self.log(f"{name}: Stopped; picked up by the next run into this folder")
+            raise
+        except Exception as e:
+            self.log(f"{name}: Error - {e}")
+            raise
+        if progress:
+            progress(j, "Completed")
+
+    def write_report(self):
+        # Per-tile stage timings go next to the outputs, with a p50/p95 summary in the log
+        if not any(tile.source for tile in self.report.tiles):
+            return
+        try:
+            report_path = self.report.save(self.save_path)
+        except OSError as e:
+            self.log(f"Could not write the run report: {e}")
+            return
+        for line in self.report.summary_lines():
+            self.log(line)
+        self.log(f"Run report saved to {report_path}")
+
+    def cancel_pending(self):
+        # Requests already sent to the model can't be interrupted; only queued tiles are dropped
+        for future in self.futures:
+            future.cancel()
+
+    def stop(self):
+        self.is_running = False
+        self.cancel_pending()
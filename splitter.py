@@ -1,19 +1,120 @@
 import sys
-from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QPushButton, QFileDialog, QLabel, QMessageBox, QHBoxLayout, QProgressBar, QTextEdit, QComboBox
+from PyQt5.QtWidgets import QApplication, QWidget, QVBoxLayout, QPushButton, QFileDialog, QLabel, QMessageBox, QHBoxLayout, QProgressBar, QTextEdit, QComboBox, QSpinBox, QCheckBox
 from PyQt5.QtGui import QPixmap, QPainter, QPen, QColor, QImage
-from PyQt5.QtCore import Qt, QRect, QPoint, QThread, pyqtSignal, QUrl
+from PyQt5.QtCore import Qt, QRect, QPoint, QThread, QTimer, pyqtSignal, QUrl
 from PIL import Image
-import io
 import os
-import asyncio
-import fal_client
-import base64
 import logging
-import requests
-import tempfile
+import queue
+import threading
+import time
+from core import (
+    BACKENDS, MODELS, DEFAULT_LINES, EXPORT_FORMATS, MODEL_TILE_SIZES, SEAMLESS_IMAGE_NAME, UPLOAD_FORMATS,
+    PreviewPyramid, TileGrid, UpscaleCache, UpscaleRun, detect_grid_lines, save_tiles, upscaled_tile_path
+)
+from strips import open_strips, save_tiles_streamed
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Set CUTANDSCALE_FRAME_STATS=1 to log frame-time histograms of painting and background rendering
+FRAME_STATS_ENABLED = os.environ.get("CUTANDSCALE_FRAME_STATS") == "1"
+
+class FrameStats:
+    BUCKETS_MS = (4, 8, 16.7, 33.3, 66.7)
+
+    def __init__(self, name, report_every=120):
+        self.name = name
+        self.report_every = report_every
+        self.counts = [0] * (len(self.BUCKETS_MS) + 1)
+        self.max_ms = 0
+
+    def record(self, seconds):
+        ms = seconds * 1000
+        bucket = next((i for i, limit in enumerate(self.BUCKETS_MS) if ms < limit), len(self.BUCKETS_MS))
+        self.counts[bucket] += 1
+        self.max_ms = max(self.max_ms, ms)
+        if sum(self.counts) % self.report_every == 0:
+            logging.info(self.summary())
+
+    def summary(self):
+        labels = [f"<{limit:g}ms" for limit in self.BUCKETS_MS] + [f">={self.BUCKETS_MS[-1]:g}ms"]
+        histogram = " | ".join(f"{label} {count}" for label, count in zip(labels, self.counts))
+        return f"{self.name} frames: {histogram} | max {self.max_ms:.1f}ms"
+
+class PreviewRenderer(QThread):
+    # Resamples and composes previews off the GUI thread. Only the latest request is kept,
+    # so a burst of resizes or updates collapses into a single render.
+    rendered = pyqtSignal(object, object, object)
+
+    def __init__(self):
+        super().__init__()
+        self.condition = threading.Condition()
+        self.job = None
+        self.is_running = True
+        self.frame_stats = FrameStats("render") if FRAME_STATS_ENABLED else None
+
+    def request(self, key, render):
+        # render() returns a PIL image and extra data handed back along with it
+        with self.condition:
+            self.job = (key, render)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.job is None and self.is_running:
+                    self.condition.wait()
+                if not self.is_running:
+                    return
+                (key, render), self.job = self.job, None
+            start = time.perf_counter()
+            try:
+                image, extra = render()
+                q_image = ImageSplitter.pil_to_qimage(image)
+            except Exception as e:
+                logging.error(f"Preview render failed: {e}")
+                continue
+            if self.frame_stats:
+                self.frame_stats.record(time.perf_counter() - start)
+            self.rendered.emit(q_image, key, extra)
+
+    def stop(self):
+        with self.condition:
+            self.is_running = False
+            self.condition.notify()
+        self.wait()
+
+class BackgroundLoader(QThread):
+    # Decodes files off the GUI thread, in the order they were asked for. Unlike the renderer
+    # every job is kept, since each finished tile has to reach the preview.
+    loaded = pyqtSignal(object, object)
+
+    def __init__(self):
+        super().__init__()
+        self.jobs = queue.Queue()
+
+    def request(self, key, load):
+        self.jobs.put((key, load))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            key, load = job
+            try:
+                result = load()
+            except Exception as e:
+                logging.error(f"Background load failed: {e}")
+                continue
+            self.loaded.emit(key, result)
+
+    def stop(self):
+        with self.jobs.mutex:
+            self.jobs.queue.clear()
+        self.jobs.put(None)
+        self.wait()
+
 class ImageLabel(QLabel):
     def __init__(self, parent):
         super().__init__(parent)
@@ -28,10 +129,24 @@ class ImageLabel(QLabel):
             QColor(255, 69, 0),   # Red-orange
             QColor(255, 99, 71)   # Tomato
         ]
+        self.frame_stats = FrameStats("paint") if FRAME_STATS_ENABLED else None
+
+    def has_image(self):
+        # The pixmap arrives from the background renderer, so it can lag behind a newly loaded image
+        pixmap = self.pixmap()
+        return bool(self.parent.preview) and pixmap is not None and not pixmap.isNull()
 
     def paintEvent(self, event):
+        start = time.perf_counter()
         super().paintEvent(event)
-        if self.parent.display_image and not self.parent.is_cut:
+        self.paint_overlay()
+        if self.frame_stats:
+            self.frame_stats.record(time.perf_counter() - start)
+
+    def paint_overlay(self):
+        if not self.has_image():
+            return
+        if not self.parent.is_cut:
             painter = QPainter(self)
             painter.setRenderHint(QPainter.Antialiasing)
             
@@ -66,6 +181,16 @@ class ImageLabel(QLabel):
                 x = int(img_rect.left() + v * img_rect.width())
                 x_coord = int(v * self.parent.original_image.width)
                 self.draw_coordinate(painter, x + 5, img_rect.top() + 15, f"x: {x_coord}")
+        elif self.parent.is_cut and self.parent.mosaic_cache and self.parent.current_upscale_index != -1:
+            # Highlight the tile being upscaled on top of the cached mosaic
+            tile_rects = self.parent.mosaic_cache[2]
+            if self.parent.current_upscale_index < len(tile_rects):
+                img_rect = self.pixmap().rect()
+                img_rect.moveCenter(self.rect().center())
+
+                painter = QPainter(self)
+                painter.setPen(QPen(Qt.red, 5))
+                painter.drawRect(tile_rects[self.parent.current_upscale_index].translated(img_rect.topLeft()))
 
     def draw_coordinate(self, painter, x, y, text):
         # Set up the font
@@ -85,7 +210,7 @@ class ImageLabel(QLabel):
         painter.drawText(x, y, text)
 
     def mousePressEvent(self, event):
-        if not self.parent.is_cut and self.parent.display_image:
+        if not self.parent.is_cut and self.has_image():
             pixmap = self.pixmap()
             img_rect = pixmap.rect()
             img_rect.moveCenter(self.rect().center())
@@ -105,7 +230,7 @@ class ImageLabel(QLabel):
         super().mousePressEvent(event)
 
     def mouseMoveEvent(self, event):
-        if not self.parent.is_cut and self.moving_line and self.parent.display_image:
+        if not self.parent.is_cut and self.moving_line and self.has_image():
             pixmap = self.pixmap()
             img_rect = pixmap.rect()
             img_rect.moveCenter(self.rect().center())
@@ -129,91 +254,111 @@ class UpscaleWorker(QThread):
     finished = pyqtSignal()
     error = pyqtSignal(str)
     log = pyqtSignal(str)
+    # Request number and its TileTimings.as_dict() row, once the request is done. Without
+    # packing every request is one tile, numbered in grid order.
+    timing = pyqtSignal(int, object)
 
-    def __init__(self, image_paths, save_path, model):
+    def __init__(self, grid, save_path, model, max_concurrency=4, cache=None, image_format="PNG", seamless=False,
+                 pack=False):
         super().__init__()
-        self.image_paths = image_paths
+        self.grid = grid
         self.save_path = save_path
-        self.model = model
-        self.is_running = True
+        self.cache = cache
+        self.seamless = seamless
+        self.upscale = UpscaleRun(grid, save_path, model, max_concurrency, cache, image_format, seamless, pack,
+                                  log=self.log.emit)
+        self.report = self.upscale.report
 
     def run(self):
-        for i, img_path in enumerate(self.image_paths):
-            if not self.is_running:
-                break
-            self.progress.emit(i, "", "Starting")
-            try:
-                self.log.emit(f"Image {i + 1}: Uploading")
-                
-                # Upload the image file
-                image_url = fal_client.upload_file(img_path)
-
-                self.log.emit(f"Image {i + 1}: Processing")
-                if self.model == "fal-ai/aura-sr":
-                    response = fal_client.run(self.model, arguments={
-                        "image_url": image_url,
-                        "upscaling_factor": 4,
-                        "checkpoint": "v2"
-                    })
-                elif self.model == "fal-ai/creative-upscaler":
-                    response = fal_client.run(self.model, arguments={
-                        "image_url": image_url,
-                        "scale": 2,
-                        "creativity": 0.1,
-                        "detail": 1,
-                        "shape_preservation": 0.25,
-                        "prompt_suffix": " high quality, highly detailed, high resolution, sharp",
-                        "negative_prompt": "blurry, low resolution, bad, ugly, low quality, pixelated, interpolated, compression artifacts, noisey, grainy",
-                        "guidance_scale": 7.5,
-                        "num_inference_steps": 20,
-                        "enable_safety_checks": True,
-                        "additional_lora_scale": 1
-                    })
-
-                upscaled_img_url = response["image"]["url"]
-                upscaled_img_path = f"{self.save_path}/upscaled_image_{i+1}.jpg"
-                
-                self.log.emit(f"Image {i + 1}: Downloading")
-                response = requests.get(upscaled_img_url)
-                if response.status_code == 200:
-                    with open(upscaled_img_path, 'wb') as f:
-                        f.write(response.content)
-                    self.log.emit(f"Image {i + 1}: Saved")
-                else:
-                    raise Exception(f"Download failed. Status code: {response.status_code}")
-
-                self.progress.emit(i, upscaled_img_path, "Completed")
-            except Exception as e:
-                self.log.emit(f"Image {i + 1}: Error - {str(e)}")
-                self.error.emit(str(e))
-                break
-
-        if self.is_running:
+        try:
+            self.upscale.run(progress=self.request_progress)
+        except Exception as e:
+            self.error.emit(str(e))
+            return
+        finally:
+            if self.cache is not None:
+                self.log.emit(self.cache.summary())
+        if self.upscale.is_running:
             self.finished.emit()
 
+    def request_progress(self, j, status):
+        job = self.upscale.jobs[j]
+        if status == "Completed":
+            self.timing.emit(j, self.report.tile(j).as_dict())
+        for i in job.indices:
+            path = upscaled_tile_path(self.save_path, i, self.seamless) if status == "Completed" else ""
+            self.progress.emit(i, path, status)
+
     def stop(self):
-        self.is_running = False
+        self.upscale.stop()
         self.log.emit("Upscale process stopped")
 
+class ExportWorker(QThread):
+    progress = pyqtSignal(int)
+    finished = pyqtSignal(str)
+    error = pyqtSignal(str)
+
+    def __init__(self, grid, save_path, export_format="JPEG", quality=100):
+        super().__init__()
+        self.grid = grid
+        self.save_path = save_path
+        self.export_format = export_format
+        self.quality = quality
+
+    def run(self):
+        try:
+            # Large TIFF and PNG sources are left undecoded by the preview; cut those a band at a time
+            # rather than decoding them whole here. Decoded sources are cut in memory on every core.
+            path = getattr(self.grid.image, "filename", None)
+            if path and open_strips(path, self.grid.image) is not None:
+                save_tiles_streamed(self.grid, path, self.save_path, self.export_format, self.quality,
+                                    progress=self.progress.emit)
+            else:
+                save_tiles(self.grid, self.save_path, self.export_format, self.quality, progress=self.progress.emit)
+        except Exception as e:
+            self.error.emit(str(e))
+            return
+        self.finished.emit(self.save_path)
+
 class ImageSplitter(QWidget):
     def __init__(self):
         super().__init__()
-        self.models = {
-            "Aura SR": "fal-ai/aura-sr",
-            "Creative Upscaler": "fal-ai/creative-upscaler"
-        }
+        self.models = dict(MODELS)
+        # Previews and mosaics are resampled on a background thread; keys identify what was asked for
+        self.renderer = PreviewRenderer()
+        self.renderer.rendered.connect(self.on_rendered)
+        self.renderer.start()
+        # Upscaled tiles and images are decoded at preview size in the background
+        self.loader = BackgroundLoader()
+        self.loader.loaded.connect(self.on_loaded)
+        self.loader.start()
+        self.requested_render_key = None
+        self.requested_mosaic_tiles = set()
+        self.rendered_key = None
+        self.preview_generation = 0
+        self.mosaic_generation = 0
+        self.load_generation = 0  # Bumped per image load, so only the latest one is shown
+        self.resize_timer = QTimer(self)
+        self.resize_timer.setSingleShot(True)
+        self.resize_timer.setInterval(40)
+        self.resize_timer.timeout.connect(self.update_display)
         self.initUI()
         self.original_image = None
-        self.display_image = None
-        self.cut_images = None
-        self.h_lines = [0.25, 0.5, 0.75]
-        self.v_lines = [0.25, 0.5, 0.75]
+        self.preview = None
+        self.cut_grid = None
+        self.h_lines = list(DEFAULT_LINES)
+        self.v_lines = list(DEFAULT_LINES)
         self.line_thickness = 2
         self.last_folder = os.path.expanduser("~")
         self.is_cut = False
         self.upscale_worker = None
+        self.export_worker = None
+        self.upscale_grid = None  # Grid of the running upscale
         self.current_upscale_index = -1
-        self.temp_dir = None
+        self.completed_upscales = 0
+        self.mosaic_cache = None
+        # Finished tiles of the cut grid at preview resolution, as (PIL image, QImage) by index
+        self.upscaled_previews = {}
 
     def initUI(self):
         self.setWindowTitle('Image Splitter')
@@ -237,6 +382,12 @@ class ImageSplitter(QWidget):
         self.cut_button.setEnabled(False)
         button_layout.addWidget(self.cut_button)
 
+        # Places the lines on the gutters or seams of sprite sheets, contact sheets and image grids
+        self.auto_grid_button = QPushButton('Auto Grid')
+        self.auto_grid_button.clicked.connect(self.auto_grid)
+        self.auto_grid_button.setEnabled(False)
+        button_layout.addWidget(self.auto_grid_button)
+
         self.undo_button = QPushButton('Undo')
         self.undo_button.clicked.connect(self.undo_cut)
         self.undo_button.setEnabled(False)
@@ -247,6 +398,17 @@ class ImageSplitter(QWidget):
         self.split_button.setEnabled(False)
         button_layout.addWidget(self.split_button)
 
+        self.export_format_selector = QComboBox()
+        self.export_format_selector.addItems(EXPORT_FORMATS.keys())
+        button_layout.addWidget(self.export_format_selector)
+
+        # Used by JPEG and WebP exports; WebP at 100 is lossless
+        self.quality_spinbox = QSpinBox()
+        self.quality_spinbox.setRange(1, 100)
+        self.quality_spinbox.setValue(100)
+        self.quality_spinbox.setPrefix("Quality: ")
+        button_layout.addWidget(self.quality_spinbox)
+
         self.upscale_button = QPushButton('Upscale')
         self.upscale_button.clicked.connect(self.upscale_images)
         self.upscale_button.setEnabled(False)
@@ -271,10 +433,35 @@ class ImageSplitter(QWidget):
         self.model_selector.addItems(self.models.keys())
         button_layout.addWidget(self.model_selector)
 
+        # Maximum number of tiles sent to the model at once
+        self.concurrency_spinbox = QSpinBox()
+        self.concurrency_spinbox.setRange(1, 16)
+        self.concurrency_spinbox.setValue(4)
+        self.concurrency_spinbox.setPrefix("Parallel: ")
+        button_layout.addWidget(self.concurrency_spinbox)
+
+        # Encoding used for tile uploads; lossless WebP is smaller than PNG
+        self.upload_format_selector = QComboBox()
+        self.upload_format_selector.addItems(UPLOAD_FORMATS.keys())
+        button_layout.addWidget(self.upload_format_selector)
+        self.model_selector.currentTextChanged.connect(self.on_model_changed)
+
+        # Upscale the whole image as overlapping model-sized tiles and stitch one seamless result
+        self.seamless_checkbox = QCheckBox("Seamless")
+        button_layout.addWidget(self.seamless_checkbox)
+
+        # Upscale small cut tiles several at a time, packed into model-sized atlases
+        self.pack_checkbox = QCheckBox("Pack small tiles")
+        button_layout.addWidget(self.pack_checkbox)
+
         layout.addLayout(button_layout)
 
         self.setLayout(layout)
 
+    def on_model_changed(self, name):
+        # Local backends upload nothing, so the upload encoding doesn't apply to them
+        self.upload_format_selector.setEnabled(BACKENDS[self.models[name]].remote)
+
     def select_image(self):
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
@@ -282,7 +469,7 @@ class ImageSplitter(QWidget):
             self,
             "Select Image File",
             QUrl.fromLocalFile(self.last_folder),
-            "Image Files (*.png *.jpg *.jpeg *.bmp *.gif)",
+            "Image Files (*.png *.jpg *.jpeg *.tif *.tiff *.bmp *.gif)",
             options=options
         )
         if file_url.isValid():
@@ -290,13 +477,22 @@ class ImageSplitter(QWidget):
             self.last_folder = os.path.dirname(file_path)
             self.load_image(file_path)
 
-    def load_image(self, file_path):
+    def load_image(self, file_path, message=None):
+        # The file is opened and its preview built on the loader thread; on a huge scan that takes
+        # seconds, and the window keeps showing the current image until the new one is ready
+        self.load_generation += 1
+        self.loader.request(("image", self.load_generation, message),
+                            lambda: self.open_with_preview(file_path))
+
+    def show_image(self, image, preview):
         try:
-            self.original_image = Image.open(file_path)
-            self.display_image = self.original_image.copy()
-            self.display_image.thumbnail((900, 700))
+            self.original_image = image
+            self.preview = preview
+            self.preview_generation += 1
+            self.invalidate_mosaic()
             self.update_display()
             self.cut_button.setEnabled(True)
+            self.auto_grid_button.setEnabled(True)
             self.split_button.setEnabled(True)
             self.upscale_button.setEnabled(True)  # Always enable upscale button
             self.is_cut = False
@@ -304,38 +500,131 @@ class ImageSplitter(QWidget):
             print(f"Error loading image: {e}")
 
     def update_display(self):
-        if self.is_cut and self.cut_images:
+        if self.is_cut and self.cut_grid:
             self.update_display_with_highlight()
-        elif self.display_image:
-            label_size = self.image_label.size()
-            scaled_image = self.display_image.copy()
-            scaled_image.thumbnail((label_size.width(), label_size.height()), Image.LANCZOS)
-            q_image = self.pil_to_qimage(scaled_image)
-            pixmap = QPixmap.fromImage(q_image)
-            self.image_label.setPixmap(pixmap)
-            self.image_label.update()
+        elif self.preview:
+            label_size = (self.image_label.width(), self.image_label.height())
+            preview = self.preview
+            self.request_render(
+                ("preview", self.preview_generation, label_size),
+                lambda: (preview.fitted(label_size), None)
+            )
 
     def update_display_with_highlight(self):
-        if not self.cut_images:
+        if not self.cut_grid:
             return
 
-        total_width = sum(img.width for img in self.cut_images[0]) + 5 * (len(self.cut_images[0]) - 1)
-        total_height = sum(row[0].height for row in self.cut_images) + 5 * (len(self.cut_images) - 1)
-        
-        combined = Image.new('RGB', (total_width, total_height), color='white')
-        
-        y_offset = 0
-        image_positions = []
-        for row in self.cut_images:
-            x_offset = 0
-            for img in row:
-                combined.paste(img, (x_offset, y_offset))
-                image_positions.append((x_offset, y_offset, img.width, img.height))
-                x_offset += img.width + 5
-            y_offset += row[0].height + 5
-
-        label_width = self.image_label.width()
-        label_height = self.image_label.height()
+        # The scaled mosaic only depends on the cut geometry and the label size; the highlight
+        # is painted by ImageLabel on top of it, so progress ticks don't recompose anything
+        label_size = (self.image_label.width(), self.image_label.height())
+        cache_key = ("mosaic", self.mosaic_generation, self.cut_grid.geometry(), label_size)
+        if self.mosaic_cache is None or self.mosaic_cache[0] != cache_key:
+            grid, preview = self.cut_grid, self.preview
+            upscaled = dict(self.upscaled_previews)
+            if cache_key not in (self.rendered_key, self.requested_render_key):
+                self.requested_mosaic_tiles = set(upscaled)
+            self.request_render(cache_key, lambda: self.build_mosaic(grid, preview, label_size, upscaled))
+        elif self.image_label.pixmap() is None or self.image_label.pixmap().cacheKey() != self.mosaic_cache[1].cacheKey():
+            self.rendered_key = cache_key
+            self.image_label.setPixmap(self.mosaic_cache[1])
+
+        self.image_label.update()
+
+    def request_render(self, key, render):
+        # Hand the resampling to the renderer thread; the label keeps its current pixmap until then
+        if key == self.rendered_key or key == self.requested_render_key:
+            return
+        self.requested_render_key = key
+        self.renderer.request(key, render)
+
+    def on_rendered(self, q_image, key, tile_rects):
+        if key != self.requested_render_key:
+            return  # superseded by a newer request
+        pixmap = QPixmap.fromImage(q_image)
+        self.rendered_key = key
+        if key[0] == "mosaic":
+            self.mosaic_cache = (key, pixmap, tile_rects)
+            # Tiles that finished while the mosaic was being composed
+            for index in set(self.upscaled_previews) - self.requested_mosaic_tiles:
+                self.swap_in_tile(index)
+        self.image_label.setPixmap(pixmap)
+        self.image_label.update()
+
+    def on_loaded(self, key, result):
+        if key[0] == "tile":
+            _, generation, index = key
+            if generation != self.mosaic_generation:
+                return  # The grid was cut again or another image loaded since
+            self.upscaled_previews[index] = result
+            if self.mosaic_cache is not None:
+                self.swap_in_tile(index)
+                self.image_label.setPixmap(self.mosaic_cache[1])
+        elif key[0] == "image":
+            _, generation, message = key
+            if generation != self.load_generation:
+                return  # Another image was picked while this one loaded
+            self.show_image(*result)
+            if message:
+                self.log_text_edit.append(message)
+        elif key[0] == "auto_grid":
+            _, generation = key
+            if generation != self.load_generation or self.is_cut:
+                return  # The lines belong to an image that is no longer shown, or the grid is cut
+            self.apply_auto_grid(*result)
+
+    def swap_in_tile(self, index):
+        # Paint one finished tile over the cached mosaic rather than composing it again
+        _, pixmap, tile_rects = self.mosaic_cache
+        if index >= len(tile_rects):
+            return
+        painter = QPainter(pixmap)
+        painter.setRenderHint(QPainter.SmoothPixmapTransform)
+        painter.drawImage(tile_rects[index], self.upscaled_previews[index][1])
+        painter.end()
+
+    def request_tile_preview(self, index, upscaled_img_path):
+        # Decoded at the size the tile has in the top preview level, so later mosaics of any
+        # label size only resample the small copy
+        left, upper, right, lower = self.cut_grid.box(index)
+        scale = self.preview.levels[0].width / self.original_image.width
+        size = (max(1, round((right - left) * scale)), max(1, round((lower - upper) * scale)))
+        self.loader.request(("tile", self.mosaic_generation, index),
+                            lambda: self.load_tile_preview(upscaled_img_path, size))
+
+    @staticmethod
+    def load_tile_preview(path, size):
+        # Runs on the loader thread. JPEG results are decoded straight at 1/2 to 1/8 scale.
+        with Image.open(path) as upscaled:
+            upscaled.draft("RGB", size)
+            tile = upscaled.resize(size, Image.LANCZOS, reducing_gap=3.0).convert("RGB")
+        return tile, ImageSplitter.pil_to_qimage(tile)
+
+    @staticmethod
+    def open_with_preview(path):
+        # Runs on the loader thread, so the preview pyramid isn't built on the GUI thread
+        image = Image.open(path)
+        return image, PreviewPyramid.for_image(image)
+
+    def resizeEvent(self, event):
+        super().resizeEvent(event)
+        # Re-render once the size settles instead of on every step of a drag
+        self.resize_timer.start()
+
+    def closeEvent(self, event):
+        self.renderer.stop()
+        self.loader.stop()
+        super().closeEvent(event)
+
+    @staticmethod
+    def build_mosaic(grid, preview, label_size, upscaled=None):
+        # Runs on the renderer thread, so it only touches its arguments. Tiles in upscaled,
+        # by index, are shown in place of the source.
+        boxes = grid.boxes
+        source = grid.image
+        total_width = source.width + 5 * (len(boxes[0]) - 1)
+        total_height = source.height + 5 * (len(boxes) - 1)
+
+        label_width, label_height = label_size
 
         aspect_ratio = total_width / total_height
 
@@ -346,55 +635,76 @@ class ImageSplitter(QWidget):
             new_height = label_height
             new_width = int(new_height * aspect_ratio)
 
-        combined_resized = combined.copy()
-        combined_resized.thumbnail((new_width, new_height), Image.LANCZOS)
-
         scale_factor = new_width / total_width
 
-        q_image = self.pil_to_qimage(combined_resized)
-        pixmap = QPixmap.fromImage(q_image)
+        # Scale the source once from the preview pyramid and lay out the scaled tiles
+        # with their gutters, instead of materializing a full-resolution mosaic
+        scaled_source = preview.resized(
+            (max(1, round(source.width * scale_factor)), max(1, round(source.height * scale_factor)))
+        )
+        combined = Image.new('RGB', (max(1, new_width), max(1, new_height)), color='white')
+
+        tile_rects = []
+        for i, row in enumerate(boxes):
+            for j, (left, upper, right, lower) in enumerate(row):
+                scaled_box = tuple(int(value * scale_factor) for value in (left, upper, right, lower))
+                x = int((left + 5 * j) * scale_factor)
+                y = int((upper + 5 * i) * scale_factor)
+                width, height = scaled_box[2] - scaled_box[0], scaled_box[3] - scaled_box[1]
+                index = len(tile_rects)
+                if upscaled and index in upscaled:
+                    tile = upscaled[index][0].resize((max(1, width), max(1, height)), Image.BILINEAR)
+                    combined.paste(tile, (x, y))
+                else:
+                    combined.paste(scaled_source.crop(scaled_box), (x, y))
+                tile_rects.append(QRect(x, y, width, height))
 
-        if self.current_upscale_index != -1 and self.current_upscale_index < len(image_positions):
-            painter = QPainter(pixmap)
-            painter.setPen(QPen(Qt.red, 5))
-            x, y, width, height = image_positions[self.current_upscale_index]
-            scaled_x = int(x * scale_factor)
-            scaled_y = int(y * scale_factor)
-            scaled_width = int(width * scale_factor)
-            scaled_height = int(height * scale_factor)
-            painter.drawRect(scaled_x, scaled_y, scaled_width, scaled_height)
-            painter.end()
+        return combined, tile_rects
 
-        self.image_label.setPixmap(pixmap)
+    def invalidate_mosaic(self):
+        # Upscaled previews belong to the grid the mosaic was cut with
+        self.mosaic_cache = None
+        self.mosaic_generation += 1
+        self.upscaled_previews = {}
+
+    def auto_grid(self):
+        if not self.original_image or self.is_cut:
+            return
+
+        # Profiling every row of a large scan takes a while, so it runs on the loader thread
+        image = self.original_image
+        self.loader.request(("auto_grid", self.load_generation), lambda: detect_grid_lines(image))
+
+    def apply_auto_grid(self, h_lines, v_lines):
+        if not h_lines and not v_lines:
+            self.log_text_edit.append("Auto grid: no gutters or seams found, keeping the current lines.")
+            return
+        # An axis without gutters gets no lines: the sheet is a single row or column
+        self.h_lines, self.v_lines = h_lines, v_lines
+        self.log_text_edit.append(f"Auto grid: {len(h_lines) + 1} rows x {len(v_lines) + 1} columns.")
         self.image_label.update()
 
     def cut_image(self):
         if not self.original_image:
             return
 
-        h_pixels = [0] + [int(h * self.original_image.height) for h in self.h_lines] + [self.original_image.height]
-        v_pixels = [0] + [int(v * self.original_image.width) for v in self.v_lines] + [self.original_image.width]
-
-        self.cut_images = []
-        for i in range(len(h_pixels) - 1):
-            row = []
-            for j in range(len(v_pixels) - 1):
-                left, upper, right, lower = v_pixels[j], h_pixels[i], v_pixels[j+1], h_pixels[i+1]
-                img = self.original_image.crop((left, upper, right, lower))
-                row.append(img)
-            self.cut_images.append(row)
+        self.cut_grid = TileGrid.from_lines(self.original_image, self.h_lines, self.v_lines)
 
+        self.invalidate_mosaic()
         self.is_cut = True
         self.undo_button.setEnabled(True)
         self.cut_button.setEnabled(False)
+        self.auto_grid_button.setEnabled(False)
         self.upscale_button.setEnabled(True)  # Always enable upscale button
         self.update_display()
 
     def undo_cut(self):
         self.is_cut = False
-        self.cut_images = None
+        self.cut_grid = None
+        self.invalidate_mosaic()
         self.undo_button.setEnabled(False)
         self.cut_button.setEnabled(True)
+        self.auto_grid_button.setEnabled(True)
         self.upscale_button.setEnabled(True)  # Always enable upscale button
         self.update_display()
 
@@ -404,46 +714,43 @@ class ImageSplitter(QWidget):
             return
 
         if self.is_cut:
-            images_to_save = [img for row in self.cut_images for img in row]
+            grid = self.cut_grid
         else:
-            display_width = self.image_label.pixmap().width()
-            display_height = self.image_label.pixmap().height()
-
-            width_scale = self.original_image.width / display_width
-            height_scale = self.original_image.height / display_height
-
-            h_pixels = [0] + [int(h * display_height * height_scale) for h in self.h_lines] + [self.original_image.height]
-            v_pixels = [0] + [int(v * display_width * width_scale) for v in self.v_lines] + [self.original_image.width]
-
-            images_to_save = []
-            for i in range(len(h_pixels) - 1):
-                for j in range(len(v_pixels) - 1):
-                    left = v_pixels[j]
-                    upper = h_pixels[i]
-                    right = v_pixels[j+1]
-                    lower = h_pixels[i+1]
-                    img = self.original_image.crop((left, upper, right, lower))
-                    images_to_save.append(img)
+            # The line fractions map straight onto the original, so this doesn't depend on the preview
+            grid = TileGrid.from_lines(self.original_image, self.h_lines, self.v_lines)
 
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
         save_path = QFileDialog.getExistingDirectory(self, "Select Directory to Save Images", self.last_folder, options=options)
         if save_path:
             self.last_folder = save_path
-            try:
-                for i, img in enumerate(images_to_save):
-                    img.save(f"{save_path}/split_image_{i+1}.jpg", quality=100, subsampling=0)
-                
-                success_message = f"Images successfully saved to {save_path}"
-                print(success_message)
-                QMessageBox.information(self, "Success", success_message)
-            except Exception as e:
-                error_message = f"Error saving images: {str(e)}"
-                print(error_message)
-                QMessageBox.critical(self, "Error", error_message)
+            # Encoding and writing happen off the GUI thread; the progress bar follows along
+            self.export_worker = ExportWorker(grid, save_path, self.export_format_selector.currentText(),
+                                              self.quality_spinbox.value())
+            self.export_worker.progress.connect(self.progress_bar.setValue)
+            self.export_worker.finished.connect(self.export_finished)
+            self.export_worker.error.connect(self.export_error)
+            self.progress_bar.setMaximum(len(grid))
+            self.progress_bar.setValue(0)
+            self.split_button.setEnabled(False)
+            self.export_worker.start()
         else:
             print("Image splitting cancelled.")
 
+    def export_finished(self, save_path):
+        self.split_button.setEnabled(True)
+        self.export_worker = None
+        success_message = f"Images successfully saved to {save_path}"
+        print(success_message)
+        QMessageBox.information(self, "Success", success_message)
+
+    def export_error(self, error_message):
+        self.split_button.setEnabled(True)
+        self.export_worker = None
+        error_message = f"Error saving images: {error_message}"
+        print(error_message)
+        QMessageBox.critical(self, "Error", error_message)
+
     def upscale_images(self):
         if not self.original_image:
             QMessageBox.warning(self, "Error", "No image loaded. Please select an image first.")
@@ -460,39 +767,44 @@ class ImageSplitter(QWidget):
         self.last_folder = save_path
         
         selected_model = self.models[self.model_selector.currentText()]
-
-        if self.is_cut and self.cut_images:
+        max_concurrency = self.concurrency_spinbox.value()
+        # Local results are as quick to redo as to copy, so only remote models use the cache
+        cache = UpscaleCache() if BACKENDS[selected_model].remote else None
+
+        image_format = self.upload_format_selector.currentText()
+        seamless = self.seamless_checkbox.isChecked()
+        pack = self.pack_checkbox.isChecked()
+
+        if seamless:
+            grid = TileGrid.for_tile_size(self.original_image, MODEL_TILE_SIZES[selected_model])
+            self.log_text_edit.append(f"Starting seamless upscale of the full image in {len(grid)} tiles...")
+        elif self.is_cut and self.cut_grid:
             # Upscale cut images
-            self.temp_dir = tempfile.TemporaryDirectory()
-            temp_image_paths = []
-            for i, row in enumerate(self.cut_images):
-                for j, img in enumerate(row):
-                    temp_path = os.path.join(self.temp_dir.name, f"temp_image_{i}_{j}.png")
-                    img.save(temp_path, format="PNG")
-                    temp_image_paths.append(temp_path)
-            
-            self.upscale_worker = UpscaleWorker(temp_image_paths, save_path, selected_model)
-            self.progress_bar.setMaximum(len(temp_image_paths))
+            grid = self.cut_grid
             self.log_text_edit.append("Starting upscale process for cut images...")
         else:
             # Upscale the entire original image
-            temp_path = os.path.join(tempfile.gettempdir(), "temp_full_image.png")
-            self.original_image.save(temp_path, format="PNG")
-            
-            self.upscale_worker = UpscaleWorker([temp_path], save_path, selected_model)
-            self.progress_bar.setMaximum(1)
+            grid = TileGrid(self.original_image, [0, self.original_image.height], [0, self.original_image.width])
             self.log_text_edit.append("Starting upscale process for full image...")
 
+        self.upscale_worker = UpscaleWorker(grid, save_path, selected_model, max_concurrency, cache, image_format, seamless,
+                                            pack)
+        self.upscale_grid = grid
+        self.progress_bar.setMaximum(len(grid))
+
         self.upscale_worker.progress.connect(self.update_upscale_progress)
         self.upscale_worker.finished.connect(self.upscale_finished)
         self.upscale_worker.error.connect(self.upscale_error)
         self.upscale_worker.log.connect(self.log_upscale_message)
 
         self.progress_bar.setValue(0)
+        self.completed_upscales = 0
         self.upscale_button.setEnabled(False)
         self.stop_upscale_button.setEnabled(True)
         
-        self.current_upscale_index = 0
+        self.current_upscale_index = 0 if self.highlights_upscale() else -1
+        if self.upscaled_previews:
+            self.invalidate_mosaic()  # Start again from the source tiles
         self.update_display_with_highlight()
         
         self.log_text_edit.clear()
@@ -504,19 +816,30 @@ class ImageSplitter(QWidget):
             self.upscale_worker.stop()
             self.upscale_worker.wait()  # Wait for the thread to finish
             self.upscale_worker = None
+            self.upscale_grid = None
             self.stop_upscale_button.setEnabled(False)
             self.upscale_button.setEnabled(True)
-            self.log_text_edit.append("Upscale process stopped.")
+            self.log_text_edit.append("Upscale process stopped. Upscaling into the same folder again resumes it.")
         else:
             self.log_text_edit.append("No upscale process is currently running.")
 
+    def highlights_upscale(self):
+        # Only the tiles of the cut grid are shown in the preview to highlight, and only while that
+        # grid is still the one on screen; Undo or a new cut during the run leaves it behind
+        return self.upscale_grid is not None and self.upscale_grid is self.cut_grid
+
     def update_upscale_progress(self, index, upscaled_img_path, status):
-        self.progress_bar.setValue(index + 1)
-        self.current_upscale_index = index
+        # Tiles finish out of order, so the bar counts completions rather than following the index
+        highlight = self.highlights_upscale()
+        self.current_upscale_index = index if highlight else -1
         if status == "Starting":
             self.log_text_edit.append(f"Starting upscale for image {index + 1}")
         elif status == "Completed":
+            self.completed_upscales += 1
+            self.progress_bar.setValue(self.completed_upscales)
             self.log_text_edit.append(f"Completed upscale for image {index + 1}")
+            if highlight and upscaled_img_path:
+                self.request_tile_preview(index, upscaled_img_path)
         self.update_display_with_highlight()
 
     def upscale_finished(self):
@@ -526,15 +849,14 @@ class ImageSplitter(QWidget):
         self.update_display()
         self.log_text_edit.append("Upscaling process completed.")
         QMessageBox.information(self, "Success", "Upscaling process completed.")
-        if self.temp_dir:
-            self.temp_dir.cleanup()
-            self.temp_dir = None
-        if not self.is_cut:
+        if self.upscale_worker and self.upscale_worker.seamless:
+            self.log_text_edit.append(f"Seamless image saved: {os.path.join(self.last_folder, SEAMLESS_IMAGE_NAME)}")
+        elif not self.is_cut:
             upscaled_image_path = os.path.join(self.last_folder, "upscaled_image_1.jpg")
             if os.path.exists(upscaled_image_path):
-                self.load_image(upscaled_image_path)
-                self.log_text_edit.append(f"Loaded upscaled image: {upscaled_image_path}")
+                self.load_image(upscaled_image_path, f"Loaded upscaled image: {upscaled_image_path}")
         self.upscale_worker = None  # Reset the worker
+        self.upscale_grid = None
 
     def upscale_error(self, error_message):
         self.log_text_edit.append(f"Error: {error_message}")
@@ -544,10 +866,8 @@ class ImageSplitter(QWidget):
         if self.upscale_worker:
             self.upscale_worker.stop()
             self.upscale_worker.wait()  # Wait for the thread to finish
-        if self.temp_dir:
-            self.temp_dir.cleanup()
-            self.temp_dir = None
         self.upscale_worker = None  # Reset the worker
+        self.upscale_grid = None
 
     def log_upscale_message(self, message):
         logging.info(message)
@@ -556,11 +876,25 @@ class ImageSplitter(QWidget):
             self.log_text_edit.verticalScrollBar().maximum()
         )
 
-    def pil_to_qimage(self, pil_image):
-        buffer = io.BytesIO()
-        pil_image.save(buffer, format='PNG')
-        q_image = QImage()
-        q_image.loadFromData(buffer.getvalue())
+    @staticmethod
+    def pil_to_qimage(pil_image):
+        # Wrap the raw pixel bytes instead of round-tripping through an encoded format
+        if pil_image.mode == "L":
+            q_format, channels = QImage.Format_Grayscale8, 1
+        elif pil_image.mode == "RGBA":
+            q_format, channels = QImage.Format_RGBA8888, 4
+        elif pil_image.mode == "RGB":
+            q_format, channels = QImage.Format_RGB888, 3
+        else:
+            # P, LA, CMYK and the rest are converted to the closest mode QImage can wrap
+            has_alpha = "A" in pil_image.getbands() or "transparency" in pil_image.info
+            pil_image = pil_image.convert("RGBA" if has_alpha else "RGB")
+            q_format, channels = (QImage.Format_RGBA8888, 4) if has_alpha else (QImage.Format_RGB888, 3)
+
+        data = pil_image.tobytes("raw", pil_image.mode)
+        q_image = QImage(data, pil_image.width, pil_image.height, pil_image.width * channels, q_format)
+        # QImage does not copy the buffer, so keep it alive for as long as the image is
+        q_image.pil_buffer = data
         return q_image
 
 if __name__ == '__main__':
@@ -0,0 +1,311 @@
+import io
+import itertools
+import math
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+from PIL import Image, TiffImagePlugin, TiffTags
+
+from core import png_chunk, save_tiles, write_tile
+
+# Rows decoded at a time are picked so a band of the source stays around this size. Cutting holds
+# a few copies of a band at once (decoded, cropped into tiles, spilled), so it is kept small.
+STREAM_BAND_BYTES = 16 * 1024 ** 2
+READ_CHUNK_SIZE = 1024 * 1024
+
+MAPPED_MODES = ("L", "P", "LA", "RGB", "RGBA", "CMYK")
+
+# Tags a band of a TIFF needs to be decoded exactly like the whole file; the strip or tile
+# layout and the image length are rewritten for the band
+TIFF_BAND_TAGS = (
+    TiffImagePlugin.IMAGEWIDTH, TiffImagePlugin.BITSPERSAMPLE, TiffImagePlugin.COMPRESSION,
+    TiffImagePlugin.PHOTOMETRIC_INTERPRETATION, TiffImagePlugin.FILLORDER, TiffImagePlugin.SAMPLESPERPIXEL,
+    TiffImagePlugin.ROWSPERSTRIP, TiffImagePlugin.PLANAR_CONFIGURATION, TiffImagePlugin.PREDICTOR,
+    TiffImagePlugin.COLORMAP, TiffImagePlugin.TILEWIDTH, TiffImagePlugin.TILELENGTH, TiffImagePlugin.EXTRASAMPLES,
+    TiffImagePlugin.SAMPLEFORMAT, TiffImagePlugin.JPEGTABLES, TiffImagePlugin.YCBCRSUBSAMPLING,
+    529, 531, 532  # YCbCrCoefficients, YCbCrPositioning, ReferenceBlackWhite
+)
+TIFF_OLD_JPEG = 6
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+PNG_CHANNELS = {0: 1, 2: 3, 3: 1, 4: 2, 6: 4}  # By color type, at 8 bits per sample
+
+
+def tiff_orientation(image):
+    # PIL turns TIFFs upright as it loads them, which a band can't do on its own
+    return image.tag_v2.get(0x0112, 1) if image.format == "TIFF" else 1
+
+
+def raw_args(tile):
+    # Raw tiles carry (rawmode, stride, orientation), or just the rawmode
+    return tile[3] if isinstance(tile[3], tuple) else (tile[3], 0, 1)
+
+
+class MappedRaster:
+    # Uncompressed 8-bit rasters (plain TIFF strips or tiles, PPM) are mapped straight from the
+    # file: a band costs a copy of its own rows and nothing else is read or decoded. Mapped pages
+    # are dropped once their band is copied, so they don't pile up in the resident set.
+    @classmethod
+    def accepts(cls, image):
+        return (image.mode in MAPPED_MODES and tiff_orientation(image) == 1 and all(
+            tile[0] == "raw" and raw_args(tile)[0] == image.mode and raw_args(tile)[2] == 1 for tile in image.tile
+        ))
+
+    def __init__(self, path, image):
+        import numpy as np
+
+        self.size = image.size
+        self.mode = image.mode
+        self.pixel_bytes = Image.getmodebands(image.mode) if image.mode != "P" else 1
+        # Bands of a palette image need its palette and transparency to mean anything. They are
+        # taken from what the header gave, since getpalette() would decode the whole image.
+        palette = image.palette if image.mode == "P" else None
+        self.palette = (palette.palette, palette.rawmode or palette.mode) if palette is not None else None
+        self.transparency = image.info.get("transparency")
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.raw = np.frombuffer(self.map, dtype=np.uint8)
+        # (left, upper, right, lower), file offset and bytes per row of every strip or tile
+        self.chunks = [
+            (tile[1], tile[2], raw_args(tile)[1] or (tile[1][2] - tile[1][0]) * self.pixel_bytes) for tile in image.tile
+        ]
+
+    def bands(self, rows):
+        import numpy as np
+
+        width, height = self.size
+        for top in range(0, height, rows):
+            bottom = min(top + rows, height)
+            band = np.empty((bottom - top, width * self.pixel_bytes), dtype=np.uint8)
+            mapped = []
+            for (left, upper, right, lower), offset, stride in self.chunks:
+                if upper >= bottom or lower <= top:
+                    continue
+                first, last = max(upper, top), min(lower, bottom)
+                start = offset + (first - upper) * stride
+                data = self.raw[start:start + (last - first) * stride].reshape(last - first, stride)
+                band[first - top:last - top, left * self.pixel_bytes:right * self.pixel_bytes] = \
+                    data[:, :(right - left) * self.pixel_bytes]
+                mapped.append((start, start + (last - first) * stride))
+            if mapped and hasattr(mmap, "MADV_DONTNEED"):
+                start = min(start for start, _ in mapped) // mmap.PAGESIZE * mmap.PAGESIZE
+                self.map.madvise(mmap.MADV_DONTNEED, start, max(end for _, end in mapped) - start)
+            band = Image.frombuffer(self.mode, (width, bottom - top), band, "raw", self.mode, 0, 1)
+            if self.palette is not None:
+                band.putpalette(*self.palette)
+            if self.transparency is not None:
+                band.info["transparency"] = self.transparency
+            yield top, band
+
+
+class TiffStrips:
+    # Any other TIFF split into strips or tiles. The strips of each band are copied into a small
+    # TIFF of their own and decoded by PIL/libtiff, so only one band is ever decompressed.
+    @classmethod
+    def accepts(cls, image):
+        tags = getattr(image, "tag_v2", None)
+        if image.format != "TIFF" or tiff_orientation(image) != 1 or tags.get(TiffImagePlugin.COMPRESSION) == TIFF_OLD_JPEG:
+            return False
+        if TiffImagePlugin.TILEOFFSETS in tags:
+            return tags.get(TiffImagePlugin.TILELENGTH, image.height) < image.height
+        return TiffImagePlugin.STRIPOFFSETS in tags and tags.get(TiffImagePlugin.ROWSPERSTRIP, image.height) < image.height
+
+    def __init__(self, path, image):
+        self.path = path
+        self.size = image.size
+        self.mode = image.mode
+        self.pixel_bytes = max(1, Image.getmodebands(image.mode))
+        self.tags = image.tag_v2
+        self.tiled = TiffImagePlugin.TILEOFFSETS in self.tags
+        if self.tiled:
+            self.offsets_tag, self.counts_tag = TiffImagePlugin.TILEOFFSETS, TiffImagePlugin.TILEBYTECOUNTS
+            self.unit = self.tags[TiffImagePlugin.TILELENGTH]
+            self.per_row = math.ceil(image.width / self.tags[TiffImagePlugin.TILEWIDTH])
+        else:
+            self.offsets_tag, self.counts_tag = TiffImagePlugin.STRIPOFFSETS, TiffImagePlugin.STRIPBYTECOUNTS
+            self.unit = self.tags.get(TiffImagePlugin.ROWSPERSTRIP, image.height)
+            self.per_row = 1
+        self.units = math.ceil(image.height / self.unit)
+        # Separate planes store all the strips of one sample before the next
+        separate = self.tags.get(TiffImagePlugin.PLANAR_CONFIGURATION, 1) == 2
+        self.planes = self.tags.get(TiffImagePlugin.SAMPLESPERPIXEL, 1) if separate else 1
+
+    def bands(self, rows):
+        step = max(1, rows // self.unit)
+        with open(self.path, "rb") as f:
+            for first in range(0, self.units, step):
+                last = min(first + step, self.units)
+                with Image.open(io.BytesIO(self.band_file(f, first, last))) as band:
+                    band.load()
+                    yield first * self.unit, band
+
+    def band_file(self, f, first, last):
+        offsets, counts = self.tags[self.offsets_tag], self.tags[self.counts_tag]
+        per_plane = self.units * self.per_row
+        chunks = []
+        for plane in range(self.planes):
+            for index in range(plane * per_plane + first * self.per_row, plane * per_plane + last * self.per_row):
+                f.seek(offsets[index])
+                chunks.append(f.read(counts[index]))
+
+        ifd = TiffImagePlugin.ImageFileDirectory_v2(prefix=self.tags.prefix)
+        for tag in TIFF_BAND_TAGS:
+            if tag in self.tags:
+                ifd.tagtype[tag] = self.tags.tagtype[tag]
+                ifd[tag] = self.tags[tag]
+        ifd[TiffImagePlugin.IMAGELENGTH] = min(last * self.unit, self.size[1]) - first * self.unit
+        ifd.tagtype[self.offsets_tag] = ifd.tagtype[self.counts_tag] = TiffTags.LONG
+        ifd[self.counts_tag] = tuple(len(chunk) for chunk in chunks)
+        # Where each chunk starts, relative to the first, when they are laid out back to back
+        positions = tuple(itertools.accumulate((len(chunk) for chunk in chunks[:-1]), initial=0))
+        if self.tags.prefix == b"II":
+            header = b"II*\x00" + struct.pack("<I", 8)
+        else:
+            header = b"MM\x00*" + struct.pack(">I", 8)
+        if self.tiled:
+            ifd[self.offsets_tag] = positions
+            start = len(header) + len(ifd.tobytes(len(header)))
+            ifd[self.offsets_tag] = tuple(start + position for position in positions)
+        else:
+            # tobytes() moves strip offsets past the directory itself
+            ifd[self.offsets_tag] = positions
+        return header + ifd.tobytes(len(header)) + b"".join(chunks)
+
+
+class PngStrips:
+    # 8-bit, non-interlaced PNG. The image data is inflated as it is read, and each band of
+    # filtered rows is wrapped in a PNG of its own for PIL to unfilter. The band starts with the
+    # row above it, unfiltered, since the filters of a band's first row refer to it.
+    @classmethod
+    def accepts(cls, image):
+        if image.format != "PNG" or image.mode not in MAPPED_MODES:
+            return False
+        with open(image.filename, "rb") as f:
+            header = f.read(33)
+        return (header[:8] == PNG_SIGNATURE and header[12:16] == b"IHDR" and header[24] == 8
+                and header[25] in PNG_CHANNELS and header[28] == 0)
+
+    def __init__(self, path, image):
+        self.path = path
+        self.size = image.size
+        self.mode = image.mode
+        self.pixel_bytes = max(1, Image.getmodebands(image.mode))
+
+    def chunks(self, f):
+        # Yields (kind, data) for the chunks before the image data, then the image data in pieces
+        f.seek(len(PNG_SIGNATURE))
+        image_data = False
+        while True:
+            length, kind = struct.unpack(">I4s", f.read(8))
+            if kind == b"IDAT":
+                image_data = True
+                while length:
+                    data = f.read(min(length, READ_CHUNK_SIZE))
+                    length -= len(data)
+                    yield kind, data
+            elif image_data or kind == b"IEND":
+                return
+            else:
+                yield kind, f.read(length)
+            f.seek(4, os.SEEK_CUR)  # CRC
+
+    def bands(self, rows):
+        width, height = self.size
+        header, decompressor, pending = [], zlib.decompressobj(), bytearray()
+        ihdr, stride, previous, top = None, None, None, 0
+        with open(self.path, "rb") as f:
+            for kind, data in self.chunks(f):
+                if kind == b"IHDR":
+                    ihdr = data
+                    stride = 1 + width * PNG_CHANNELS[data[9]]
+                elif kind in (b"PLTE", b"tRNS"):
+                    header.append(png_chunk(kind, data))
+                elif kind == b"IDAT":
+                    while data:
+                        pending += decompressor.decompress(data, READ_CHUNK_SIZE)
+                        data = decompressor.unconsumed_tail
+                        while top < height and len(pending) >= min(rows, height - top) * stride:
+                            count = min(rows, height - top)
+                            with memoryview(pending) as view:
+                                band = self.decode(ihdr, header, view[:count * stride], count, previous)
+                            del pending[:count * stride]
+                            previous = band.crop((0, count - 1, width, count)).tobytes()
+                            yield top, band
+                            top += count
+        if top < height:
+            raise Exception(f"PNG image data ends after {top} of {height} rows")
+
+    def decode(self, ihdr, header, filtered, count, previous):
+        # Stored (level 0) deflate: PIL only has to unfilter the rows, not inflate them again
+        compressor = zlib.compressobj(0)
+        prefix = compressor.compress(b"\x00" + previous) if previous is not None else b""
+        data = prefix + compressor.compress(filtered) + compressor.flush()
+        rows = count + (previous is not None)
+        png = b"".join([
+            PNG_SIGNATURE, png_chunk(b"IHDR", struct.pack(">II", self.size[0], rows) + ihdr[8:]), *header,
+            struct.pack(">I", len(data)), b"IDAT", data, struct.pack(">I", zlib.crc32(data, zlib.crc32(b"IDAT"))),
+            png_chunk(b"IEND", b""),
+        ])
+        del data
+        with Image.open(io.BytesIO(png)) as band:
+            band.load()
+            return band.crop((0, rows - count, self.size[0], rows)) if previous is not None else band.copy()
+
+
+def open_strips(path, image):
+    # A reader that yields the source in bands of rows, or None if it can only be decoded whole
+    if not getattr(image, "tile", None):
+        return None  # Already decoded
+    for reader in (MappedRaster, TiffStrips, PngStrips):
+        if reader.accepts(image):
+            return reader(path, image)
+    return None
+
+
+def save_tiles_streamed(grid, path, save_path, export_format="JPEG", quality=100, band_bytes=STREAM_BAND_BYTES,
+                        progress=None):
+    # Cut the file at path into the tiles of grid without decoding it whole. Each band of the
+    # source is cut into the rows of the tiles it crosses, which are appended to a spill file per
+    # tile; a tile is encoded as soon as its last row is in. The most held in memory is one band
+    # plus one tile. Sources that can't be read in bands are cut in memory with save_tiles.
+    image = grid.image
+    reader = open_strips(path, image)
+    if reader is None:
+        return save_tiles(grid, save_path, export_format, quality, workers=1, progress=progress)
+
+    rows = max(1, band_bytes // (image.width * reader.pixel_bytes))
+    boxes = [grid.box(index) for index in range(len(grid))]
+    paths = [None] * len(grid)
+    spills = {}
+    with tempfile.TemporaryDirectory(prefix=".cut-", dir=save_path) as spill_dir:
+        for top, band in reader.bands(rows):
+            bottom = top + band.height
+            for index, (left, upper, right, lower) in enumerate(boxes):
+                if paths[index] or upper >= bottom or lower <= top:
+                    continue
+                if index not in spills:
+                    spills[index] = open(os.path.join(spill_dir, str(index)), "wb")
+                spills[index].write(band.crop((left, max(upper, top) - top, right, min(lower, bottom) - top)).tobytes())
+                if lower <= bottom:
+                    spills.pop(index).close()
+                    tile = load_spilled(os.path.join(spill_dir, str(index)), band, (right - left, lower - upper))
+                    tile.info = dict(image.info)
+                    paths[index] = write_tile(tile, index, save_path, export_format, quality)
+                    os.remove(os.path.join(spill_dir, str(index)))
+                    if progress:
+                        progress(sum(p is not None for p in paths))
+    if None in paths:
+        raise Exception(f"Source ended before {paths.count(None)} tiles were complete")
+    return paths
+
+
+def load_spilled(spill_path, band, size):
+    # Rows were spilled in the band's own raw layout; a palette is carried over from the band
+    with open(spill_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        tile = Image.frombytes(band.mode, size, data)
+    if band.mode in ("P", "PA"):
+        tile.putpalette(band.getpalette())
+    return tile
@@ -0,0 +1,39 @@
+import random
+
+import pytest
+from PIL import Image
+
+from core import detect_grid_lines
+
+# Nine hues that all have luminance 128
+EQUAL_LUMINANCE = [(40, 192, 30), (90, 129, 220), (140, 123, 120), (230, 58, 220), (40, 155, 220),
+                   (190, 115, 30), (90, 166, 30), (190, 78, 220), (140, 104, 220)]
+
+
+def cut_rows(h_lines, height):
+    return [int(line * height) for line in h_lines]
+
+
+def test_seams_between_equal_luminance_cells():
+    assert len({Image.new("RGB", (1, 1), color).convert("L").getpixel((0, 0)) for color in EQUAL_LUMINANCE}) == 1
+    image = Image.new("RGB", (300, 240))
+    for index, color in enumerate(EQUAL_LUMINANCE):
+        row, column = divmod(index, 3)
+        image.paste(color, (column * 100, row * 80, column * 100 + 100, row * 80 + 80))
+    h_lines, v_lines = detect_grid_lines(image)
+    assert cut_rows(h_lines, 240) == [80, 160]
+    assert cut_rows(v_lines, 300) == [100, 200]
+
+
+@pytest.mark.parametrize("mode", ["RGB", "RGBA"])
+def test_gutters_between_noisy_cells(mode):
+    rng = random.Random(0)
+    image = Image.new(mode, (410, 410), "white")
+    for row in range(2):
+        for column in range(2):
+            cell = Image.new(mode, (200, 200))
+            cell.putdata([tuple(rng.randrange(256) for _ in mode) for _ in range(200 * 200)])
+            image.paste(cell, (column * 210, row * 210))
+    h_lines, v_lines = detect_grid_lines(image)
+    assert cut_rows(h_lines, 410) == [205]
+    assert cut_rows(v_lines, 410) == [205]
@@ -0,0 +1,110 @@
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from core import TileTimings, create_session, download_file
+
+
+class Responses:
+    # A local stand-in for the result CDN: each GET is answered by the next scripted response, a
+    # (status, body, declared length) tuple; a declared length longer than the body truncates it
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = 0
+        owner = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                status, body, length = owner.responses[min(owner.requests, len(owner.responses) - 1)]
+                owner.requests += 1
+                self.send_response(status)
+                self.send_header("Content-Length", str(length if length is not None else len(body)))
+                if length is not None:
+                    self.send_header("Connection", "close")
+                self.end_headers()
+                self.wfile.write(body)
+                if length is not None:
+                    self.close_connection = True
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.server.server_port}/result.png"
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(*responses):
+        servers.append(Responses(*responses))
+        return servers[-1]
+    yield start
+    for server in servers:
+        server.close()
+
+
+def leftovers(directory):
+    return [name for name in os.listdir(directory) if name.startswith(".download-")]
+
+
+def test_retries_unavailable_then_succeeds(serve, tmp_path):
+    server = serve((503, b"busy", None), (200, b"image bytes", None))
+    dest = tmp_path / "tile.png"
+    size = download_file(server.url, str(dest), backoff=0, log=lambda message: None)
+    assert size == len(b"image bytes")
+    assert dest.read_bytes() == b"image bytes"
+    assert server.requests == 2
+
+
+def test_truncated_body_is_retried(serve, tmp_path):
+    server = serve((200, b"partial", 100), (200, b"complete body", None))
+    dest = tmp_path / "tile.png"
+    download_file(server.url, str(dest), session=create_session(), backoff=0, log=lambda message: None)
+    assert dest.read_bytes() == b"complete body"
+    assert server.requests == 2
+    assert leftovers(tmp_path) == []
+
+
+def test_truncated_body_fails_after_retries(serve, tmp_path):
+    server = serve((200, b"partial", 100))
+    dest = tmp_path / "tile.png"
+    with pytest.raises(Exception):
+        download_file(server.url, str(dest), retries=2, backoff=0, log=lambda message: None)
+    assert server.requests == 3
+    assert not dest.exists()
+    assert leftovers(tmp_path) == []
+
+
+def test_not_found_fails_without_retry_or_temp_file(serve, tmp_path):
+    server = serve((404, b"missing", None))
+    dest = tmp_path / "tile.png"
+    with pytest.raises(Exception, match="404"):
+        download_file(server.url, str(dest), backoff=0, log=lambda message: None)
+    assert server.requests == 1
+    assert not dest.exists()
+    assert leftovers(tmp_path) == []
+
+
+def test_large_body_is_streamed_to_disk(serve, tmp_path):
+    # Several download chunks, each written as it arrives and timed as the write stage
+    body = os.urandom(3 * 1024 * 1024 + 123)
+    server = serve((200, body, None))
+    dest = tmp_path / "tile.png"
+    timings = TileTimings()
+    size = download_file(server.url, str(dest), timings=timings)
+    assert size == len(body)
+    assert dest.read_bytes() == body
+    assert timings.stages["download"][1] == len(body)
+    assert timings.stages["write"][1] == len(body)
+    assert leftovers(tmp_path) == []
@@ -0,0 +1,161 @@
+import io
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import fal_client
+import httpx
+import pytest
+from PIL import Image
+
+import core
+from core import RunManifest, TileTimings, UpscaleCancelled, attempt_upscale, prepare_tile, wait_for_result
+
+MODEL = "fal-ai/aura-sr"
+
+
+class FakeQueue:
+    # Stands in for fal's queue endpoints. Each request answers status polls with its scripted
+    # statuses in turn, repeating the last one; results are served by a local HTTP server.
+    def __init__(self, monkeypatch):
+        self.statuses = {}
+        self.submits = []
+        self.polls = 0
+        self.expired = set()  # Requests whose result URL no longer answers
+        expired = self.expired
+        buffer = io.BytesIO()
+        Image.new("RGB", (32, 32), "gray").save(buffer, "PNG")
+        body = buffer.getvalue()
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.strip("/").split(".")[0] in expired:
+                    self.send_response(404)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        monkeypatch.setattr(fal_client, "upload", lambda data, content_type: "fake://upload")
+        monkeypatch.setattr(fal_client, "submit", self.submit)
+        monkeypatch.setattr(fal_client, "status", self.status)
+        monkeypatch.setattr(fal_client, "result", self.result)
+        monkeypatch.setattr(core, "QUEUE_POLL_INTERVAL", 0)
+
+    def script(self, request_id, *statuses):
+        self.statuses[request_id] = list(statuses)
+
+    def submit(self, model, arguments):
+        request_id = f"new-{len(self.submits)}"
+        self.submits.append(arguments)
+        self.script(request_id, fal_client.Completed(logs=[], metrics={}))
+        return type("Handle", (), {"request_id": request_id})()
+
+    def status(self, model, request_id, with_logs=False):
+        self.polls += 1
+        statuses = self.statuses[request_id]
+        if isinstance(statuses[0], Exception):
+            raise statuses[0]
+        return statuses.pop(0) if len(statuses) > 1 else statuses[0]
+
+    def result(self, model, request_id):
+        return {"image": {"url": f"http://127.0.0.1:{self.server.server_port}/{request_id}.png"}}
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def queue(monkeypatch):
+    fake = FakeQueue(monkeypatch)
+    yield fake
+    fake.close()
+
+
+def not_found():
+    request = httpx.Request("GET", "https://queue.fal.run/status")
+    return fal_client.FalClientHTTPError("Request not found", 404, {}, httpx.Response(404, request=request))
+
+
+def test_wait_for_result_passes_queue_position_and_logs(queue):
+    first, second = {"message": "Loading model"}, {"message": "Upscaling"}
+    queue.script(
+        "request",
+        fal_client.Queued(position=2),
+        fal_client.Queued(position=2),
+        fal_client.Queued(position=1),
+        fal_client.InProgress(logs=[first]),
+        fal_client.Completed(logs=[first, second], metrics={"inference_time": 0}),
+    )
+    messages = []
+    timings = TileTimings()
+    result = wait_for_result(MODEL, "request", log=messages.append, interval=0, timings=timings)
+    assert result["image"]["url"].endswith("/request.png")
+    # Unchanged positions and logs already passed on are not repeated
+    assert messages == ["Queued, position 2", "Queued, position 1", "Loading model", "Upscaling"]
+    assert set(timings.stages) == {"queue", "inference"}
+
+
+def test_stopping_while_queued_cancels(queue):
+    queue.script("request", fal_client.Queued(position=5))
+    checks = iter([True, True, True, False])
+    with pytest.raises(UpscaleCancelled):
+        wait_for_result(MODEL, "request", log=lambda message: None, is_running=lambda: next(checks), interval=0)
+    assert queue.polls == 3
+
+
+def submitted_tile(tmp_path, request_id):
+    # A prepared tile whose request an earlier, stopped run recorded in the manifest
+    manifest = RunManifest(str(tmp_path))
+    prepared = prepare_tile(Image.new("RGB", (8, 8), "red"), MODEL)
+    output_path = os.path.join(str(tmp_path), "upscaled_image_1.png")
+    manifest.submitted(manifest.name_for(output_path), prepared[1], MODEL, request_id)
+    return prepared, output_path, RunManifest(str(tmp_path))
+
+
+def test_resume_collects_recorded_request_without_submitting(queue, tmp_path):
+    queue.script("earlier", fal_client.InProgress(logs=[]), fal_client.Completed(logs=[], metrics={}))
+    prepared, output_path, manifest = submitted_tile(tmp_path, "earlier")
+    timings = TileTimings()
+    size = attempt_upscale(prepared, output_path, MODEL, log=lambda message: None, manifest=manifest,
+                           timings=timings)
+    assert queue.submits == []
+    assert timings.source == "resumed"
+    assert size == os.path.getsize(output_path)
+    assert manifest.is_done(manifest.name_for(output_path), prepared[1])
+
+
+def test_resume_of_expired_request_submits_again(queue, tmp_path):
+    queue.script("expired", not_found())
+    prepared, output_path, manifest = submitted_tile(tmp_path, "expired")
+    messages = []
+    timings = TileTimings()
+    attempt_upscale(prepared, output_path, MODEL, log=messages.append, manifest=manifest, timings=timings)
+    assert len(queue.submits) == 1
+    assert timings.source == "upscaled"
+    assert any(message.startswith("Could not resume request expired") for message in messages)
+    assert manifest.is_done(manifest.name_for(output_path), prepared[1])
+    assert os.path.exists(output_path)
+
+
+def test_resume_with_expired_result_url_submits_again(queue, tmp_path):
+    queue.script("earlier", fal_client.Completed(logs=[], metrics={}))
+    queue.expired.add("earlier")
+    prepared, output_path, manifest = submitted_tile(tmp_path, "earlier")
+    messages = []
+    timings = TileTimings()
+    attempt_upscale(prepared, output_path, MODEL, log=messages.append, manifest=manifest, timings=timings)
+    assert len(queue.submits) == 1
+    assert timings.source == "upscaled"
+    assert any(message.startswith("Could not download the result of request earlier") for message in messages)
+    assert manifest.is_done(manifest.name_for(output_path), prepared[1])
+    assert os.path.exists(output_path)
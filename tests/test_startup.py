@@ -0,0 +1,20 @@
+import pytest
+
+from bench import LAZY_MODULES, STARTUP_BUDGETS_MS, import_profile
+
+# Import times vary with the machine's load, so each module gets the best of a few fresh imports
+ATTEMPTS = 3
+
+
+@pytest.mark.parametrize("module", sorted(STARTUP_BUDGETS_MS))
+def test_import_stays_within_budget(module):
+    profiles = [import_profile(module) for _ in range(ATTEMPTS)]
+    milliseconds = min(seconds for seconds, _, _ in profiles) * 1000
+    assert milliseconds <= STARTUP_BUDGETS_MS[module], f"import {module} took {milliseconds:.0f} ms"
+
+
+@pytest.mark.parametrize("module", sorted(STARTUP_BUDGETS_MS))
+def test_import_leaves_heavy_modules_for_first_use(module):
+    _, _, loaded = import_profile(module)
+    assert loaded == [], f"import {module} pulled in {', '.join(loaded)}"
+    assert {"numpy", "requests", "httpx", "fal_client"} <= set(LAZY_MODULES)
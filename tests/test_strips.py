@@ -0,0 +1,72 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from core import PreviewPyramid, TileGrid, save_tiles
+from strips import MappedRaster, PngStrips, TiffStrips, open_strips, save_tiles_streamed
+
+# Source file, save options and the reader it should be streamed with
+SOURCES = {
+    "raw RGB TIFF": ("rgb.tif", "RGB", {}, MappedRaster),
+    "raw palette TIFF": ("p.tif", "P", {}, MappedRaster),
+    "LZW RGB TIFF": ("rgb_lzw.tif", "RGB", {"compression": "tiff_lzw"}, TiffStrips),
+    "LZW palette TIFF": ("p_lzw.tif", "P", {"compression": "tiff_lzw"}, TiffStrips),
+    "RGB PNG": ("rgb.png", "RGB", {}, PngStrips),
+    "RGBA PNG": ("rgba.png", "RGBA", {}, PngStrips),
+    "palette PNG": ("p.png", "P", {"transparency": 0}, PngStrips),
+}
+
+
+def source_image(mode):
+    # Noise, so a band or a palette mixed up anywhere shows in the pixels
+    rng = np.random.default_rng(7)
+    image = Image.fromarray(rng.integers(0, 256, (301, 457, 4), dtype=np.uint8), "RGBA")
+    if mode == "P":
+        return image.convert("RGB").convert("P", palette=Image.ADAPTIVE)
+    return image.convert(mode)
+
+
+def write_source(tmp_path, name):
+    filename, mode, options, reader = SOURCES[name]
+    path = str(tmp_path / filename)
+    source_image(mode).save(path, **options)
+    return path, reader
+
+
+def same_pixels(first, second):
+    with Image.open(first) as a, Image.open(second) as b:
+        return a.size == b.size and a.convert("RGBA").tobytes() == b.convert("RGBA").tobytes()
+
+
+@pytest.mark.parametrize("name", SOURCES)
+def test_streamed_cut_matches_in_memory_cut(tmp_path, name):
+    path, reader = write_source(tmp_path, name)
+    with Image.open(path) as image:
+        assert isinstance(open_strips(path, image), reader)
+    streamed_dir, memory_dir = tmp_path / "streamed", tmp_path / "memory"
+    streamed_dir.mkdir()
+    memory_dir.mkdir()
+    # Small bands, so tiles are assembled from several of them
+    with Image.open(path) as image:
+        grid = TileGrid.from_lines(image, [0.3, 0.7], [0.5])
+        streamed = save_tiles_streamed(grid, path, str(streamed_dir), "PNG", band_bytes=16 * 1024)
+    with Image.open(path) as image:
+        grid = TileGrid.from_lines(image, [0.3, 0.7], [0.5])
+        in_memory = save_tiles(grid, str(memory_dir), "PNG", workers=1)
+    assert [os.path.basename(p) for p in streamed] == [os.path.basename(p) for p in in_memory]
+    for first, second in zip(streamed, in_memory):
+        assert same_pixels(first, second), os.path.basename(first)
+
+
+@pytest.mark.parametrize("name", SOURCES)
+def test_banded_preview_matches_in_memory_preview(tmp_path, name):
+    path, reader = write_source(tmp_path, name)
+    with Image.open(path) as image:
+        banded = PreviewPyramid.from_bands(open_strips(path, image), image, max_size=128)
+    with Image.open(path) as image:
+        image.load()
+        in_memory = PreviewPyramid(image, max_size=128)
+    assert banded.levels[0].mode == in_memory.levels[0].mode
+    assert banded.levels[0].tobytes() == in_memory.levels[0].tobytes()